@@ -0,0 +1,160 @@
+import sqlite3
+import threading
+import time
+
+
+class ApiBudget:
+    """
+    A budget of Google Maps calls per endpoint, with a daily limit and a
+    per-minute token bucket. Both are kept in SQLite, so every worker process
+    draws from the same budget and it survives a restart.
+    """
+    def __init__(self, path, limits, reserve):
+        """
+        Initializes an instance of this class. The database is only opened
+        on first use.
+        :param path: The path of the SQLite database file.
+        :param limits: A dictionary of endpoints to a dictionary with the
+        most calls "per_day" and "per_minute". Endpoints missing from it, or
+        limits of None, are not limited.
+        :param reserve: The fraction of the daily limit under which the
+        budget of an endpoint is considered low.
+        """
+        self.path = path
+        self.limits = limits
+        self.reserve = reserve
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        """
+        Opens the database and creates the tables if needed.
+        :return: The SQLite connection.
+        """
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS api_usage ("
+                "day TEXT NOT NULL, "
+                "endpoint TEXT NOT NULL, "
+                "calls INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (day, endpoint))")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS api_buckets ("
+                "endpoint TEXT PRIMARY KEY, "
+                "tokens REAL NOT NULL, "
+                "updated_at REAL NOT NULL)")
+        return self._conn
+
+    def _limit(self, endpoint, period):
+        """
+        Gets a limit of an endpoint.
+        :param endpoint: The name of the endpoint.
+        :param period: "per_day" or "per_minute".
+        :return: The limit, or None if not limited.
+        """
+        return self.limits.get(endpoint, {}).get(period)
+
+    def acquire(self, endpoint, cost=1, max_wait=0):
+        """
+        Takes calls from the budget of an endpoint. When the minute's tokens
+        run out, waits for the bucket to refill if that takes no longer than
+        the maximum wait.
+        :param endpoint: The name of the endpoint.
+        :param cost: The number of calls to take, such as the number of
+        elements of a Distance Matrix request.
+        :param max_wait: The most seconds to wait for the per-minute limit.
+        :return: True if the budget allowed the calls; otherwise false.
+        """
+        deadline = time.time() + max_wait
+        while True:
+            wait = self._try_acquire(endpoint, cost)
+            if wait == 0:
+                return True
+            if wait is None or time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def _try_acquire(self, endpoint, cost):
+        """
+        Takes calls from the budget if both limits allow them.
+        :param endpoint: The name of the endpoint.
+        :param cost: The number of calls to take.
+        :return: 0 if the calls were taken, the number of seconds until the
+        per-minute limit allows them, or None if the daily limit is spent.
+        """
+        per_day = self._limit(endpoint, "per_day")
+        per_minute = self._limit(endpoint, "per_minute")
+        day = time.strftime("%Y-%m-%d")
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            # Take the write lock first so processes can't overdraw
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT calls FROM api_usage WHERE day = ? AND endpoint = ?",
+                                   (day, endpoint)).fetchone()
+                calls = row[0] if row else 0
+                if per_day is not None and calls + cost > per_day:
+                    conn.execute("COMMIT")
+                    return None
+
+                # Refill the bucket for the time since it was last used
+                if per_minute is not None:
+                    row = conn.execute(
+                        "SELECT tokens, updated_at FROM api_buckets WHERE endpoint = ?",
+                        (endpoint,)).fetchone()
+                    tokens = per_minute if row is None else min(
+                        per_minute, row[0] + (now - row[1]) * per_minute / 60.0)
+                    # A request larger than the bucket may take it whole
+                    needed = min(cost, per_minute)
+                    if tokens < needed:
+                        conn.execute("COMMIT")
+                        return (needed - tokens) * 60.0 / per_minute
+                    conn.execute(
+                        "INSERT OR REPLACE INTO api_buckets (endpoint, tokens, updated_at) "
+                        "VALUES (?, ?, ?)",
+                        (endpoint, tokens - needed, now))
+
+                conn.execute(
+                    "INSERT OR IGNORE INTO api_usage (day, endpoint, calls) VALUES (?, ?, 0)",
+                    (day, endpoint))
+                conn.execute(
+                    "UPDATE api_usage SET calls = calls + ? WHERE day = ? AND endpoint = ?",
+                    (cost, day, endpoint))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return 0
+
+    def remaining(self):
+        """
+        Gets what is left of today's budget of each endpoint with a daily
+        limit.
+        :return: A dictionary of endpoints to the number of calls left.
+        """
+        day = time.strftime("%Y-%m-%d")
+        with self._lock:
+            used = dict(self._connection().execute(
+                "SELECT endpoint, calls FROM api_usage WHERE day = ?", (day,)).fetchall())
+        remaining = {}
+        for endpoint in self.limits:
+            per_day = self._limit(endpoint, "per_day")
+            if per_day is not None:
+                remaining[endpoint] = max(0, per_day - used.get(endpoint, 0))
+        return remaining
+
+    def is_low(self, endpoint):
+        """
+        Checks if the daily budget of an endpoint is running low, so callers
+        can fall back to cached results and defer the rest.
+        :param endpoint: The name of the endpoint.
+        :return: True if less than the reserve is left; otherwise false.
+        """
+        per_day = self._limit(endpoint, "per_day")
+        if per_day is None:
+            return False
+        return self.remaining().get(endpoint, per_day) < per_day * self.reserve
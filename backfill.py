@@ -0,0 +1,65 @@
+import datetime
+import time
+from sqlalchemy import or_, func
+from storage import EnrichmentBackfill, session, db_lock
+
+# The kinds of deferred lookups
+BACKFILL_GEOCODE = "geocode"
+BACKFILL_COMMUTE = "commute"
+
+def backfill_rows(listings, attempts=None):
+    """
+    Builds the enrichment_backfill rows of the deferred listings in a batch.
+    :param listings: A batch of ListingRecords.
+    :param attempts: A dictionary of (cl_id, kind) to the number of times
+    the lookup was already tried. Other lookups start at 0.
+    :return: A list of row dictionaries.
+    """
+    now = datetime.datetime.now()
+    attempts = attempts or {}
+    return [{"cl_id": listing.cl_id, "kind": listing.deferred, "enqueued_at": now,
+             "attempts": attempts.get((listing.cl_id, listing.deferred), 0)}
+            for listing in listings if listing.deferred is not None]
+
+def claim_backfill(kinds, owner, limit, lease):
+    """
+    Claims the oldest deferred lookups, so no other worker resolves them at
+    the same time. A claim that is not completed expires after the lease.
+    :param kinds: A list of the kinds of lookups to claim.
+    :param owner: A unique name of the worker.
+    :param limit: The most lookups to claim.
+    :param lease: The number of seconds the claim lasts.
+    :return: A list of (id, cl_id, kind, attempts) tuples.
+    """
+    if not kinds:
+        return []
+
+    now = time.time()
+    available = or_(EnrichmentBackfill.claimed_until.is_(None),
+                    EnrichmentBackfill.claimed_until < now)
+    with db_lock:
+        ids = [row[0] for row in session.query(EnrichmentBackfill.id).filter(
+            EnrichmentBackfill.kind.in_(kinds), available).order_by(
+            EnrichmentBackfill.id).limit(limit)]
+        if not ids:
+            session.commit()
+            return []
+
+        # Check the claim again in the update, in case another worker won
+        session.query(EnrichmentBackfill).filter(
+            EnrichmentBackfill.id.in_(ids), available).update(
+            {"claimed_by": owner, "claimed_until": now + lease}, synchronize_session=False)
+        session.commit()
+
+    return session.query(EnrichmentBackfill.id, EnrichmentBackfill.cl_id,
+                         EnrichmentBackfill.kind, EnrichmentBackfill.attempts).filter(
+        EnrichmentBackfill.id.in_(ids), EnrichmentBackfill.claimed_by == owner).all()
+
+def pending_backfill_count():
+    """
+    Counts the deferred lookups waiting to be resolved.
+    :return: A dictionary of kinds to counts.
+    """
+    rows = session.query(EnrichmentBackfill.kind, func.count(EnrichmentBackfill.id)).group_by(
+        EnrichmentBackfill.kind).all()
+    return dict(rows)
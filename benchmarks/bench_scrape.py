@@ -0,0 +1,224 @@
+"""
+Benchmarks Scraper.scrape offline. Craigslist and Slack are replaced by
+in-process fakes and the Google Maps endpoints by a local HTTP stub, then a
+synthetic workload is scraped once into a fresh database.
+
+Run from the repository root:
+    python benchmarks/bench_scrape.py --listings 1000 --areas 5
+    python benchmarks/bench_scrape.py --matrix
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeCraigslistHousing, FakeSlackClient, install_fakes, build_workload
+from gmaps_stub import GoogleMapsStub
+import settings
+
+# The (listings, areas) workloads run by --matrix
+PRESETS = [(100, 1), (1000, 5), (10000, 20), (100000, 50)]
+
+def configure(workdir, args):
+    """
+    Points every database and output file at the working directory, and
+    removes the delays meant for the live services.
+    :param workdir: The directory of the benchmark files.
+    :param args: The parsed command line arguments.
+    """
+    db_path = os.path.join(workdir, "listings.db")
+    settings.DATABASE_URL = "sqlite:///" + db_path
+    settings.CACHE_DB_PATH = db_path
+    settings.SLACK_QUEUE_DB_PATH = db_path
+    settings.API_BUDGET_DB_PATH = db_path
+    settings.GMAPS_BUDGETS = {}
+    settings.METRICS_FILE = os.path.join(workdir, "metrics.json")
+    settings.WORK_ADDRESS = "1 Frank H Ogawa Plaza, Oakland, CA"
+    settings.SCRAPE_INITIAL_RESULTS = None
+    settings.SCRAPE_MAX_RESULTS = args.listings
+    settings.SCRAPE_POLITENESS_DELAY = 0
+    settings.SLACK_CHANNEL_INTERVAL = 0
+    settings.SLACK_QUEUE_POLL_INTERVAL = 0.05
+
+def percentile(values, fraction):
+    """
+    Gets a percentile of a list of values.
+    :param values: A sorted list of values.
+    :param fraction: The percentile between 0 and 1.
+    :return: The value, or 0 for an empty list.
+    """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run(args):
+    """
+    Runs one benchmark.
+    :param args: The parsed command line arguments.
+    :return: A dictionary of the results.
+    """
+    workdir = tempfile.mkdtemp(prefix="bench-scrape-")
+    configure(workdir, args)
+    install_fakes()
+
+    stub = GoogleMapsStub(args.gmaps_latency)
+    base_url = stub.start()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    # Import the scraper only once the settings and fakes are in place
+    import location_helper
+    from scraper import Scraper
+    from condition import LocationCondition, PriceCondition, CommuteCondition
+    location_helper.GMAPS_GEOCODE_URL = base_url + "/maps/api/geocode/json"
+    location_helper.GMAPS_DIRECTIONS_URL = base_url + "/maps/api/directions/json"
+    location_helper.GMAPS_DISTANCE_MATRIX_URL = base_url + "/maps/api/distancematrix/json"
+    location_helper.gmaps_rate_limiter = location_helper.RateLimiter(args.gmaps_qps)
+
+    areas = ["a{:02d}".format(index) for index in range(args.areas)]
+    FakeCraigslistHousing.workloads = build_workload(args.listings, areas,
+                                                     args.no_geotag_rate, args.seed)
+    FakeCraigslistHousing.page_latency = args.page_latency
+    FakeSlackClient.latency = args.slack_latency
+
+    try:
+        scraper = Scraper(site="sfbay",
+                          category="apa",
+                          areas_filters_dict=dict((area, {}) for area in areas),
+                          slack_settings={"slack_token": "", "slack_channel": "#bench"})
+        scraper.add_condition(PriceCondition(settings.MIN_PRICE, settings.MAX_PRICE))
+        scraper.add_condition(LocationCondition())
+        scraper.add_condition(CommuteCondition(45 * 60))
+
+        # Time each listing from its fetch until it is saved
+        persisted_at = {}
+        persist_stage = scraper._persist_stage
+
+        def timed_persist_stage(listings):
+            results = persist_stage(listings)
+            now = time.perf_counter()
+            for listing in listings:
+                persisted_at[listing.cl_id] = now
+            return results
+
+        scraper._persist_stage = timed_persist_stage
+
+        start = time.perf_counter()
+        scraper.scrape()
+        elapsed = time.perf_counter() - start
+
+        # Let the Slack queue catch up; it is not part of the throughput
+        deadline = time.time() + args.slack_timeout
+        while scraper.slack_queue.pending_count() and time.time() < deadline:
+            time.sleep(0.05)
+        scraper.slack_queue.stop(timeout=5)
+
+        peak_memory = tracemalloc.get_traced_memory()[1] if args.tracemalloc else 0
+        latencies = sorted(persisted_at[cl_id] - emitted_at
+                           for cl_id, emitted_at in FakeCraigslistHousing.emitted_at.items()
+                           if cl_id in persisted_at)
+        return {
+            "listings": args.listings,
+            "areas": args.areas,
+            "saved": len(persisted_at),
+            "seconds": elapsed,
+            "listings_per_second": len(persisted_at) / elapsed if elapsed else 0,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "peak_memory_mb": peak_memory / 2 ** 20,
+            "gmaps_requests": stub.requests,
+            "slack_posts": len(scraper.slack_client.posts),
+            "slack_pending": scraper.slack_queue.pending_count()
+        }
+    finally:
+        stub.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def format_result(result):
+    """
+    Formats the results of a benchmark as one line.
+    :param result: The dictionary returned by run.
+    :return: The formatted line.
+    """
+    return ("{listings:>7} listings {areas:>3} areas | {seconds:8.2f}s "
+            "{listings_per_second:9.1f} listings/s | p50 {p50_ms:8.1f}ms p99 {p99_ms:8.1f}ms | "
+            "peak {peak_memory_mb:7.1f}MB | maps {gmaps_requests} | slack {slack_posts} posts").format(
+                **result)
+
+def run_matrix(args):
+    """
+    Runs every preset workload, each in its own process so the caches,
+    database and peak memory start fresh.
+    :param args: The parsed command line arguments.
+    :return: A list of result dictionaries.
+    """
+    results = []
+    for listings, areas in PRESETS:
+        command = [sys.executable, os.path.abspath(__file__),
+                   "--listings", str(listings),
+                   "--areas", str(areas),
+                   "--page-latency", str(args.page_latency),
+                   "--gmaps-latency", str(args.gmaps_latency),
+                   "--gmaps-qps", str(args.gmaps_qps),
+                   "--slack-latency", str(args.slack_latency),
+                   "--no-geotag-rate", str(args.no_geotag_rate),
+                   "--seed", str(args.seed),
+                   "--json"]
+        if not args.tracemalloc:
+            command.append("--no-tracemalloc")
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(format_result(result))
+        results.append(result)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--listings", type=int, default=1000,
+                        help="the number of listings to scrape")
+    parser.add_argument("--areas", type=int, default=5,
+                        help="the number of areas to spread the listings over")
+    parser.add_argument("--matrix", action="store_true",
+                        help="run the preset workloads from 100 to 100k listings")
+    parser.add_argument("--page-latency", type=float, default=0.05,
+                        help="seconds per Craigslist page of 120 listings")
+    parser.add_argument("--gmaps-latency", type=float, default=0.02,
+                        help="seconds per Google Maps request")
+    parser.add_argument("--gmaps-qps", type=float, default=0,
+                        help="Google Maps requests per second, 0 for no limit")
+    parser.add_argument("--slack-latency", type=float, default=0,
+                        help="seconds per Slack post")
+    parser.add_argument("--slack-timeout", type=float, default=30,
+                        help="seconds to wait for the Slack queue to drain")
+    parser.add_argument("--no-geotag-rate", type=float, default=0.1,
+                        help="the fraction of listings without a geotag")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false",
+                        help="skip measuring the peak memory, which slows the run")
+    parser.add_argument("--min-throughput", type=float, default=0,
+                        help="fail if fewer listings per second are saved")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = run_matrix(args) if args.matrix else [run(args)]
+    if not args.matrix:
+        print(json.dumps(results[0]) if args.json else format_result(results[0]))
+
+    slow = [result for result in results
+            if result["listings_per_second"] < args.min_throughput]
+    if slow:
+        print("Regression: {} workloads below {} listings/s".format(len(slow), args.min_throughput))
+        sys.exit(1)
+
+if "__main__" == __name__:
+    main()
@@ -0,0 +1,147 @@
+"""
+Benchmarks the cold start of the scraper. Each run is a fresh interpreter
+that imports the scraper and main_loop and creates a Scraper, with
+Craigslist and Slack replaced by fakes. A cold start must not touch the
+network or the databases, so each run also fails if it opened a database,
+created the HTTP session, or wrote any file.
+
+Run from the repository root:
+    python benchmarks/bench_startup.py --runs 10 --max-seconds 1.5
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def child(workdir):
+    """
+    Runs one cold start and prints the timings as JSON. Runs in its own
+    interpreter, started by run.
+    :param workdir: An empty directory every file must be written to.
+    """
+    start = time.perf_counter()
+    from fakes import install_fakes
+    import settings
+    db_path = os.path.join(workdir, "listings.db")
+    settings.DATABASE_URL = "sqlite:///" + db_path
+    settings.CACHE_DB_PATH = db_path
+    settings.SLACK_QUEUE_DB_PATH = db_path
+    settings.API_BUDGET_DB_PATH = db_path
+    settings.JOB_QUEUE_DB_PATH = db_path
+    settings.METRICS_FILE = os.path.join(workdir, "metrics.json")
+    settings.WORK_ADDRESS = "1 Frank H Ogawa Plaza, Oakland, CA"
+    settings.GMAPS_MAX_RETRIES = 0
+    install_fakes()
+
+    import_start = time.perf_counter()
+    import scraper
+    import main_loop
+    import_seconds = time.perf_counter() - import_start
+
+    # Should a lookup slip into the cold start, fail fast instead of calling Google
+    import location_helper
+    location_helper.GMAPS_GEOCODE_URL = "http://127.0.0.1:9/maps/api/geocode/json"
+
+    create_start = time.perf_counter()
+    search = settings.SEARCHES[0]
+    main_loop.create_scraper(search["site"], search["category"], search["areas"],
+                             deliver_slack=False)
+    create_seconds = time.perf_counter() - create_start
+
+    import storage
+    side_effects = []
+    if storage._engine is not None:
+        side_effects.append("created the database engine")
+    if location_helper._http_session is not None:
+        side_effects.append("created the HTTP session")
+    if os.listdir(workdir):
+        side_effects.append("wrote {}".format(", ".join(sorted(os.listdir(workdir)))))
+
+    print(json.dumps({
+        "import_seconds": import_seconds,
+        "create_seconds": create_seconds,
+        "child_seconds": time.perf_counter() - start,
+        "side_effects": side_effects
+    }))
+
+def run():
+    """
+    Runs one cold start in a fresh interpreter.
+    :return: A dictionary of the timings, with the wall time of the whole
+    process in "seconds".
+    """
+    workdir = tempfile.mkdtemp(prefix="bench-startup-")
+    try:
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", workdir],
+                                check=True, stdout=subprocess.PIPE, cwd=workdir,
+                                universal_newlines=True).stdout
+        seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = json.loads(output.strip().splitlines()[-1])
+    result["seconds"] = seconds
+    return result
+
+def median(values):
+    """
+    Gets the median of a list of values.
+    :param values: A non-empty list of values.
+    :return: The median.
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5,
+                        help="the number of cold starts to measure")
+    parser.add_argument("--max-seconds", type=float, default=1.5,
+                        help="fail if the median cold start takes longer")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    parser.add_argument("--child", metavar="WORKDIR", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    runs = [run() for _ in range(args.runs)]
+    result = {
+        "runs": args.runs,
+        "seconds": median([run["seconds"] for run in runs]),
+        "max_seconds": max(run["seconds"] for run in runs),
+        "import_seconds": median([run["import_seconds"] for run in runs]),
+        "create_seconds": median([run["create_seconds"] for run in runs]),
+        "side_effects": sorted(set(effect for run in runs for effect in run["side_effects"]))
+    }
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(("{runs} cold starts | median {seconds:.3f}s max {max_seconds:.3f}s | "
+               "import {import_seconds:.3f}s | create scraper {create_seconds:.3f}s").format(**result))
+
+    failed = False
+    if result["side_effects"]:
+        print("Regression: The cold start {}".format("; ".join(result["side_effects"])))
+        failed = True
+    if result["seconds"] > args.max_seconds:
+        print("Regression: The median cold start took {:.3f}s, over {}s".format(
+            result["seconds"], args.max_seconds))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if "__main__" == __name__:
+    main()
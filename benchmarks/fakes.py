@@ -0,0 +1,147 @@
+import datetime
+import json
+import os
+import random
+import sys
+import threading
+import time
+import types
+
+# The number of results python-craigslist gets per page
+CRAIGSLIST_PAGE_SIZE = 120
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "craigslist_page.json")
+
+class FakeCraigslistHousing:
+    """
+    Stands in for python-craigslist's CraigslistHousing. Replays the results
+    of a workload built with build_workload, sleeping once per page to
+    simulate the page download.
+    """
+    # The results of each area, newest first
+    workloads = {}
+
+    # The number of seconds each page takes to download
+    page_latency = 0
+
+    # The time each listing was handed to the scraper, keyed on its id
+    emitted_at = {}
+    emitted_lock = threading.Lock()
+
+    def __init__(self, site, category, area, filters=None):
+        """
+        Initializes an instance of this class.
+        :param site: The Craigslist site.
+        :param category: The category of the housing search.
+        :param area: The area to replay.
+        :param filters: Ignored.
+        """
+        self.site = site
+        self.category = category
+        self.area = area
+        self.filters = filters
+
+    def get_results(self, sort_by=None, geotagged=False, limit=None):
+        """
+        Yields the recorded results of the area.
+        :param sort_by: Ignored; the results are always newest first.
+        :param geotagged: Ignored; the workload already holds the geotags.
+        :param limit: The most results to yield, or None for all of them.
+        :return: A generator of result dictionaries.
+        """
+        results = self.workloads.get(self.area, [])
+        if limit is not None:
+            results = results[:limit]
+
+        for index, result in enumerate(results):
+            if index % CRAIGSLIST_PAGE_SIZE == 0 and self.page_latency:
+                time.sleep(self.page_latency)
+            with self.emitted_lock:
+                self.emitted_at[int(result["id"])] = time.perf_counter()
+            yield result
+
+class FakeSlackClient:
+    """
+    Stands in for slackclient's SlackClient. Every post succeeds after an
+    optional delay.
+    """
+    # The number of seconds each post takes
+    latency = 0
+
+    def __init__(self, token):
+        """
+        Initializes an instance of this class.
+        :param token: Ignored.
+        """
+        self.token = token
+        self.posts = []
+
+    def api_call(self, method, **kwargs):
+        """
+        Records an API call.
+        :param method: The Slack API method.
+        :param kwargs: The arguments of the call.
+        :return: A successful response.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        self.posts.append((method, kwargs))
+        return {"ok": True}
+
+def install_fakes():
+    """
+    Registers the fakes as the craigslist and slackclient modules. Must be
+    called before a Scraper is created.
+    """
+    craigslist = types.ModuleType("craigslist")
+    craigslist.CraigslistHousing = FakeCraigslistHousing
+    sys.modules["craigslist"] = craigslist
+
+    slackclient = types.ModuleType("slackclient")
+    slackclient.SlackClient = FakeSlackClient
+    sys.modules["slackclient"] = slackclient
+
+def build_workload(listing_count, areas, no_geotag_rate=0.1, seed=0):
+    """
+    Builds synthetic Craigslist results from the recorded page. Each listing
+    gets a unique id and title, a jittered price and position, and a
+    creation time, so they are neither duplicates nor reposts of each other.
+    :param listing_count: The total number of listings.
+    :param areas: A list of areas to spread the listings over.
+    :param no_geotag_rate: The fraction of listings without a geotag.
+    :param seed: The seed of the random generator.
+    :return: A dictionary of areas to lists of results, newest first.
+    """
+    with open(FIXTURE_PATH) as fixture:
+        templates = json.load(fixture)
+
+    rng = random.Random(seed)
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    geotagged = [template for template in templates if template["geotag"]]
+    workloads = dict((area, []) for area in areas)
+    for index in range(listing_count):
+        area = areas[index % len(areas)]
+        template = templates[index % len(templates)]
+        cl_id = 7000000000 + index
+        price = int(template["price"].replace("$", "").replace(",", ""))
+        price = int(price * rng.uniform(0.8, 1.2))
+
+        geotag = None
+        if rng.random() >= no_geotag_rate:
+            lat, lon = (template["geotag"] or rng.choice(geotagged)["geotag"])
+            geotag = [lat + rng.uniform(-0.01, 0.01), lon + rng.uniform(-0.01, 0.01)]
+
+        created = now - datetime.timedelta(minutes=index // len(areas))
+        workloads[area].append({
+            "id": str(cl_id),
+            "repost_of": None,
+            "name": "{} #{}".format(template["name"], rng.randrange(10 ** 6)),
+            "url": "https://sfbay.craigslist.org/{}/apa/d/{}.html".format(area, cl_id),
+            "datetime": created.strftime("%Y-%m-%d %H:%M"),
+            "price": "${:,}".format(price),
+            "where": template["where"],
+            "has_image": template["has_image"],
+            "has_map": geotag is not None,
+            "geotag": geotag
+        })
+    return workloads
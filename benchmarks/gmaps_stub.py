@@ -0,0 +1,117 @@
+import hashlib
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+# Where the stub geocodes every address around, in Oakland
+CENTER = (37.8272, -122.2594)
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class GoogleMapsStub:
+    """
+    A local HTTP server answering the Geocode, Directions and Distance Matrix
+    endpoints with deterministic results after a configurable delay.
+    """
+    def __init__(self, latency=0):
+        """
+        Initializes an instance of this class.
+        :param latency: The number of seconds each request takes.
+        """
+        self.latency = latency
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        """
+        Starts serving on a free local port from a background thread.
+        :return: The base URL of the stub, such as http://127.0.0.1:8000.
+        """
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+                body = json.dumps(stub.respond(url.path, params)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, name="gmaps-stub",
+                         daemon=True).start()
+        return "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def respond(self, path, params):
+        """
+        Builds the response of a request.
+        :param path: The path of the request.
+        :param params: A dictionary of the query parameters.
+        :return: The response as a dictionary.
+        """
+        endpoint = path.rstrip("/").split("/")[-2]
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if endpoint == "geocode":
+            lat, lon = geocode(params.get("address", ""))
+            return {"status": "OK",
+                    "results": [{"geometry": {"location": {"lat": lat, "lng": lon}}}]}
+
+        if endpoint == "directions":
+            duration = travel_time(params["origin"], params["destination"])
+            return {"status": "OK",
+                    "routes": [{"legs": [{"duration": {"value": duration}}]}]}
+
+        if endpoint == "distancematrix":
+            rows = [{"elements": [{"status": "OK",
+                                   "duration": {"value": travel_time(origin,
+                                                                     params["destinations"])}}]}
+                    for origin in params["origins"].split("|")]
+            return {"status": "OK", "rows": rows}
+
+        return {"status": "INVALID_REQUEST"}
+
+def geocode(address):
+    """
+    Places an address at a stable position near the center.
+    :param address: The address text.
+    :return: A tuple of (lat, lon).
+    """
+    digest = hashlib.md5(address.lower().encode("utf-8")).digest()
+    return (CENTER[0] + (digest[0] - 128) / 2560.0,
+            CENTER[1] + (digest[1] - 128) / 2560.0)
+
+def travel_time(origin, destination):
+    """
+    Estimates a transit time from the straight-line distance.
+    :param origin: The origin as "lat,lon".
+    :param destination: The destination as "lat,lon".
+    :return: The travel time in seconds.
+    """
+    lat1, lon1 = [float(value) for value in origin.split(",")]
+    lat2, lon2 = [float(value) for value in destination.split(",")]
+    km = math.hypot(lat1 - lat2, (lon1 - lon2) * math.cos(math.radians(lat1))) * 111
+    return int(600 + km * 180)
@@ -0,0 +1,209 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import metrics
+
+
+class LRUCache:
+    """
+    A small in-process cache that evicts the least recently used entry once
+    it is full. Every entry carries its own expiry timestamp.
+    """
+    def __init__(self, max_size):
+        """
+        Initializes an instance of this class.
+        :param max_size: The maximum number of entries to keep in memory.
+        """
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """
+        Looks up a key in the cache.
+        :param key: The key to look up.
+        :return: A tuple of (found, value).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return False, None
+
+            self._entries.move_to_end(key)
+            return True, value
+
+    def store(self, key, value, expires_at):
+        """
+        Stores a value in the cache, evicting the oldest entry if needed.
+        :param key: The key to store.
+        :param value: The value to store.
+        :param expires_at: The epoch time after which the entry is stale.
+        """
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class PersistentCache:
+    """
+    A key-value table stored in SQLite. Values are serialized as JSON and
+    every entry carries its own expiry timestamp.
+    """
+    def __init__(self, path, table):
+        """
+        Initializes an instance of this class. The database is only opened
+        on first use.
+        :param path: The path of the SQLite database file.
+        :param table: The name of the table holding the entries.
+        """
+        self.path = path
+        self.table = table
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        """
+        Opens the database and creates the table if needed.
+        :return: The SQLite connection.
+        """
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS {} ("
+                "key TEXT PRIMARY KEY, "
+                "value TEXT, "
+                "expires_at REAL NOT NULL)".format(self.table))
+            self._conn.commit()
+        return self._conn
+
+    def lookup(self, key):
+        """
+        Looks up a key in the table.
+        :param key: The key to look up.
+        :return: A tuple of (found, value, expires_at).
+        """
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value, expires_at FROM {} WHERE key = ?".format(self.table),
+                (key,)).fetchone()
+
+        if row is None or row[1] <= time.time():
+            return False, None, None
+        return True, json.loads(row[0]), row[1]
+
+    def store(self, key, value, expires_at):
+        """
+        Stores a value in the table, replacing any previous entry.
+        :param key: The key to store.
+        :param value: A JSON-serializable value.
+        :param expires_at: The epoch time after which the entry is stale.
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO {} (key, value, expires_at) "
+                "VALUES (?, ?, ?)".format(self.table),
+                (key, json.dumps(value), expires_at))
+            conn.commit()
+
+    def purge_expired(self):
+        """
+        Deletes every stale entry from the table.
+        :return: The number of deleted entries.
+        """
+        with self._lock:
+            conn = self._connection()
+            cursor = conn.execute(
+                "DELETE FROM {} WHERE expires_at <= ?".format(self.table),
+                (time.time(),))
+            conn.commit()
+            return cursor.rowcount
+
+
+class TieredCache:
+    """
+    An in-process LRU cache in front of a persistent SQLite table. A value of
+    None is treated as a negative result and is kept for a shorter time.
+    """
+    def __init__(self, path, table, max_size, ttl, negative_ttl):
+        """
+        Initializes an instance of this class.
+        :param path: The path of the SQLite database file.
+        :param table: The name of the table holding the entries.
+        :param max_size: The maximum number of entries to keep in memory.
+        :param ttl: The number of seconds to keep a result.
+        :param negative_ttl: The number of seconds to keep a negative result.
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory = LRUCache(max_size)
+        self.disk = PersistentCache(path, table)
+        self.name = table
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def lookup(self, key):
+        """
+        Looks up a key in memory first, then in the persistent table.
+        :param key: The key to look up.
+        :return: A tuple of (found, value).
+        """
+        found, value = self.memory.lookup(key)
+        if found:
+            self._record("memory_hits")
+            return True, value
+
+        found, value, expires_at = self.disk.lookup(key)
+        if found:
+            self._record("disk_hits")
+            self.memory.store(key, value, expires_at)
+            return True, value
+
+        self._record("misses")
+        return False, None
+
+    def _record(self, outcome):
+        """
+        Counts the outcome of a lookup.
+        :param outcome: One of the keys of the stats dictionary.
+        """
+        self.stats[outcome] += 1
+        metrics.increment("cache_lookups_total", cache=self.name, result=outcome)
+
+    def store(self, key, value):
+        """
+        Stores a value in both tiers.
+        :param key: The key to store.
+        :param value: A JSON-serializable value, or None for a negative result.
+        """
+        ttl = self.negative_ttl if value is None else self.ttl
+        expires_at = time.time() + ttl
+        self.memory.store(key, value, expires_at)
+        self.disk.store(key, value, expires_at)
+
+    def hit_rate(self):
+        """
+        Calculates the fraction of lookups answered by either tier.
+        :return: The hit rate between 0 and 1.
+        """
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
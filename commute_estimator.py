@@ -0,0 +1,124 @@
+import numpy as np
+from sqlalchemy import or_
+import location_helper
+import settings
+from storage import Listing, session
+
+class CommuteEstimator:
+    """
+    Estimates commute times offline from the commute times already looked up
+    for earlier listings. The estimate is the weighted mean of the nearby
+    listings when there are enough of them, and otherwise a baseline of a
+    fixed time plus a time per kilometer of straight-line distance to work.
+    Each estimate comes with a confidence band.
+    """
+    def __init__(self, work_geocode):
+        """
+        Initializes an instance of this class.
+        :param work_geocode: A tuple of (lat, lon) of the work address.
+        """
+        self.work_geocode = work_geocode
+        self.lats = None
+        self.lons = None
+        self.times = None
+        self.intercept = None
+        self.seconds_per_km = None
+        self.sigma = None
+
+    def fit(self, lats, lons, times):
+        """
+        Fits the estimator on looked up commute times. Too few samples leave
+        it unfitted.
+        :param lats: The latitudes of the listings.
+        :param lons: The longitudes of the listings.
+        :param times: The commute times in seconds.
+        :return: This estimator.
+        """
+        times = np.asarray(times, dtype=float)
+        if len(times) < settings.COMMUTE_ESTIMATOR_MIN_SAMPLES:
+            return self
+
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.times = times
+
+        # Fit the baseline by least squares on the distance to work
+        distances = self._work_distances(self.lats, self.lons)
+        design = np.vstack([np.ones_like(distances), distances]).T
+        (intercept, seconds_per_km), _, _, _ = np.linalg.lstsq(design, times, rcond=None)
+        if seconds_per_km <= 0:
+            intercept, seconds_per_km = times.mean(), 0.0
+        self.intercept = intercept
+        self.seconds_per_km = seconds_per_km
+        self.sigma = (times - (intercept + seconds_per_km * distances)).std()
+        return self
+
+    def is_fitted(self):
+        """
+        Checks if the estimator has enough samples to estimate.
+        :return: True if fitted; otherwise false.
+        """
+        return self.sigma is not None
+
+    def estimate(self, lats, lons):
+        """
+        Estimates the commute times of a batch of listings.
+        :param lats: The latitudes of the listings.
+        :param lons: The longitudes of the listings.
+        :return: A tuple of arrays (estimates, lows, highs) in seconds, the
+        lows and highs bounding the confidence band.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        estimates = self.intercept + self.seconds_per_km * self._work_distances(lats, lons)
+        spreads = np.full(len(lats), self.sigma)
+
+        # Use the nearby listings instead where there are enough of them
+        distances = location_helper.coord_distances(lats, lons, self.lats, self.lons)
+        k = min(settings.COMMUTE_ESTIMATOR_NEIGHBORS, len(self.times))
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        for index in range(len(lats)):
+            neighbors = nearest[index][distances[index, nearest[index]] <=
+                                       settings.COMMUTE_ESTIMATOR_RADIUS]
+            if len(neighbors) < settings.COMMUTE_ESTIMATOR_MIN_NEIGHBORS:
+                continue
+            # Closer listings weigh more; the offset avoids dividing by zero
+            weights = 1.0 / (distances[index, neighbors] + 0.05)
+            estimates[index] = np.average(self.times[neighbors], weights=weights)
+            spreads[index] = np.sqrt(np.average(
+                (self.times[neighbors] - estimates[index]) ** 2, weights=weights))
+
+        half_widths = np.maximum(settings.COMMUTE_ESTIMATOR_CONFIDENCE * spreads,
+                                 settings.COMMUTE_ESTIMATOR_MIN_BAND)
+        return estimates, estimates - half_widths, estimates + half_widths
+
+    def _work_distances(self, lats, lons):
+        """
+        Finds the straight-line distances to work.
+        :param lats: An array of latitudes.
+        :param lons: An array of longitudes.
+        :return: An array of kilometer distances.
+        """
+        return location_helper.coord_distances(lats, lons,
+                                               [self.work_geocode[0]],
+                                               [self.work_geocode[1]])[:, 0]
+
+def load_commute_estimator(work_geocode):
+    """
+    Fits an estimator on the latest commute times looked up with the API.
+    Estimated commute times are left out so errors don't feed on themselves.
+    :param work_geocode: A tuple of (lat, lon) of the work address.
+    :return: The CommuteEstimator, which may be unfitted.
+    """
+    rows = session.query(Listing.lat, Listing.lon, Listing.commute_time).filter(
+        Listing.commute_time > 0,
+        Listing.lat.isnot(None), Listing.lon.isnot(None),
+        Listing.lat != 0,
+        or_(Listing.commute_estimated.is_(None), Listing.commute_estimated.is_(False))).order_by(
+        Listing.id.desc()).limit(settings.COMMUTE_ESTIMATOR_MAX_SAMPLES).all()
+
+    estimator = CommuteEstimator(work_geocode)
+    if rows:
+        lats, lons, times = zip(*rows)
+        estimator.fit(lats, lons, times)
+    return estimator
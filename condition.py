@@ -1,6 +1,15 @@
 from abc import ABC, abstractmethod
 
+# Cost tiers of conditions, in the order they are evaluated. A listing is only
+# enriched with the information of a tier once it passed the cheaper tiers.
+COST_LOCAL = 0    # Only needs the fields scraped from Craigslist
+COST_GEO = 1      # Needs the latitude and longitude
+COST_COMMUTE = 2  # Needs the commute time
+
 class Condition(ABC):
+    # The cost tier of the information the condition needs
+    cost = COST_LOCAL
+
     @abstractmethod
     def check(self, listing):
         """
@@ -10,6 +19,8 @@ class Condition(ABC):
         pass
 
 class LocationCondition(Condition):
+    cost = COST_GEO
+
     def check(self, listing):
         """
         Checks if the listing is in the approved locations.
@@ -17,3 +28,70 @@ class LocationCondition(Condition):
         """
         return True
 
+class PriceCondition(Condition):
+    cost = COST_LOCAL
+
+    def __init__(self, min_price=None, max_price=None):
+        """
+        Initializes an instance of this class.
+        :param min_price: The minimum price, or None for no minimum.
+        :param max_price: The maximum price, or None for no maximum.
+        """
+        self.min_price = min_price
+        self.max_price = max_price
+
+    def check(self, listing):
+        """
+        Checks if the listing price is within the price range.
+        :return: True if the price is within the range or unknown; otherwise false.
+        """
+        price = listing.price
+        if price is None:
+            return True
+
+        if self.min_price is not None and price < self.min_price:
+            return False
+        if self.max_price is not None and price > self.max_price:
+            return False
+        return True
+
+class KeywordCondition(Condition):
+    cost = COST_LOCAL
+
+    def __init__(self, excluded_keywords):
+        """
+        Initializes an instance of this class.
+        :param excluded_keywords: A list of keywords that disqualify a listing.
+        """
+        self.excluded_keywords = [keyword.lower() for keyword in excluded_keywords]
+
+    def check(self, listing):
+        """
+        Checks if the listing title is free of the excluded keywords.
+        :return: True if no excluded keyword is in the title; otherwise false.
+        """
+        name = (listing.name or "").lower()
+        for keyword in self.excluded_keywords:
+            if keyword in name:
+                return False
+        return True
+
+class CommuteCondition(Condition):
+    cost = COST_COMMUTE
+
+    def __init__(self, max_commute_time):
+        """
+        Initializes an instance of this class.
+        :param max_commute_time: The longest acceptable commute in seconds.
+        """
+        self.max_commute_time = max_commute_time
+
+    def check(self, listing):
+        """
+        Checks if the commute time to work is short enough.
+        :return: True if the commute is short enough or unknown; otherwise false.
+        """
+        commute_time = listing.commute_time
+        if commute_time is None or commute_time <= 0:
+            return True
+        return commute_time <= self.max_commute_time
@@ -0,0 +1,196 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class JobQueue:
+    """
+    A queue of scrape jobs persisted in SQLite and shared by every worker
+    process, on this host or on others mounting the same file. Each job is
+    one shard of (site, category, area). A worker takes a job by leasing it,
+    so no two workers scrape the same shard at once; a lease that is not
+    renewed expires and the job goes back to the queue.
+    """
+    def __init__(self, path):
+        """
+        Initializes an instance of this class. The database is only opened
+        on first use.
+        :param path: The path of the SQLite database file.
+        """
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        """
+        Opens the database and creates the table if needed. The connection is
+        in autocommit mode so leases can be taken in explicit transactions.
+        :return: The SQLite connection.
+        """
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS scrape_jobs ("
+                "key TEXT PRIMARY KEY, "
+                "site TEXT NOT NULL, "
+                "category TEXT NOT NULL, "
+                "area TEXT NOT NULL, "
+                "filters TEXT NOT NULL, "
+                "next_run_at REAL NOT NULL, "
+                "interval REAL, "
+                "errors INTEGER NOT NULL DEFAULT 0, "
+                "lease_owner TEXT, "
+                "lease_expires_at REAL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_scrape_jobs_next_run_at "
+                "ON scrape_jobs (next_run_at)")
+        return self._conn
+
+    def add_job(self, site, category, area, filters, interval):
+        """
+        Adds a shard to the queue, due right away. A shard already queued
+        keeps its schedule and only gets the new filters.
+        :param site: The Craigslist site.
+        :param category: The category of the housing search.
+        :param area: The area.
+        :param filters: A dictionary of Craigslist filters.
+        :param interval: The interval in seconds until the arrival rate of the
+        shard is known.
+        :return: The key of the job.
+        """
+        key = job_key(site, category, area)
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR IGNORE INTO scrape_jobs "
+                "(key, site, category, area, filters, next_run_at, interval) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, site, category, area, json.dumps(filters), time.time(), interval))
+            conn.execute("UPDATE scrape_jobs SET filters = ? WHERE key = ?",
+                         (json.dumps(filters), key))
+        return key
+
+    def retain(self, keys):
+        """
+        Removes the jobs of shards no longer searched.
+        :param keys: The keys of the jobs to keep.
+        """
+        with self._lock:
+            conn = self._connection()
+            keys = set(keys)
+            existing = [row[0] for row in conn.execute("SELECT key FROM scrape_jobs")]
+            removed = [key for key in existing if key not in keys]
+            conn.executemany("DELETE FROM scrape_jobs WHERE key = ?",
+                             [(key,) for key in removed])
+
+    def lease(self, owner, duration):
+        """
+        Leases the job that has been due the longest.
+        :param owner: A unique name of the worker.
+        :param duration: The number of seconds the lease lasts.
+        :return: A dictionary of the job, or None if no job is due.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            # Take the write lock first so two workers can't pick the same job
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT key, site, category, area, filters, interval, errors "
+                    "FROM scrape_jobs WHERE next_run_at <= ? "
+                    "AND (lease_expires_at IS NULL OR lease_expires_at < ?) "
+                    "ORDER BY next_run_at LIMIT 1",
+                    (now, now)).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE scrape_jobs SET lease_owner = ?, lease_expires_at = ? "
+                        "WHERE key = ?",
+                        (owner, now + duration, row[0]))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return None
+        return {
+            "key": row[0],
+            "site": row[1],
+            "category": row[2],
+            "area": row[3],
+            "filters": json.loads(row[4]),
+            "interval": row[5],
+            "errors": row[6]
+        }
+
+    def renew(self, key, owner, duration):
+        """
+        Extends a lease held by a worker.
+        :param key: The key of the job.
+        :param owner: The name of the worker holding the lease.
+        :param duration: The number of seconds the lease lasts from now.
+        :return: True if the lease was still held; otherwise false.
+        """
+        with self._lock:
+            cursor = self._connection().execute(
+                "UPDATE scrape_jobs SET lease_expires_at = ? "
+                "WHERE key = ? AND lease_owner = ?",
+                (time.time() + duration, key, owner))
+        return cursor.rowcount == 1
+
+    def complete(self, key, owner, next_run_at, interval, errors):
+        """
+        Releases a lease and plans the next run of the job.
+        :param key: The key of the job.
+        :param owner: The name of the worker holding the lease.
+        :param next_run_at: The epoch time the job is due again.
+        :param interval: The polling interval of the shard in seconds.
+        :param errors: The number of consecutive errors of the shard.
+        :return: True if the lease was still held; otherwise false, and the
+        schedule is left to the worker now holding it.
+        """
+        with self._lock:
+            cursor = self._connection().execute(
+                "UPDATE scrape_jobs SET next_run_at = ?, interval = ?, errors = ?, "
+                "lease_owner = NULL, lease_expires_at = NULL "
+                "WHERE key = ? AND lease_owner = ?",
+                (next_run_at, interval, errors, key, owner))
+        return cursor.rowcount == 1
+
+    def seconds_until_next_job(self):
+        """
+        Finds how long to wait until a job is due.
+        :return: The number of seconds, 0 if a job is already due, or None if
+        the queue is empty.
+        """
+        with self._lock:
+            next_run_at = self._connection().execute(
+                "SELECT MIN(MAX(next_run_at, COALESCE(lease_expires_at, 0))) "
+                "FROM scrape_jobs").fetchone()[0]
+        if next_run_at is None:
+            return None
+        return max(0, next_run_at - time.time())
+
+    def next_run_times(self):
+        """
+        Gets the planned run time of every job.
+        :return: A dictionary of job keys to epoch times.
+        """
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT key, next_run_at FROM scrape_jobs").fetchall()
+        return dict(rows)
+
+def job_key(site, category, area):
+    """
+    Builds the key of a shard. It matches the key of the area_states table.
+    :param site: The Craigslist site.
+    :param category: The category of the housing search.
+    :param area: The area.
+    :return: The key made of the site, category and area.
+    """
+    return "{}/{}/{}".format(site, category, area)
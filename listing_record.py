@@ -0,0 +1,158 @@
+import datetime
+
+
+class ListingRecord:
+    """
+    A listing moving through the scraper. The fields scraped from Craigslist
+    are parsed once at ingest; the location and commute fields are filled in
+    by the enrichment stages. A listing whose lookup was put off for lack of
+    API budget names the lookup in deferred.
+    """
+    __slots__ = ("cl_id", "url", "name", "price", "created", "where", "geotag",
+                 "area", "repost_of", "lat", "lon", "commute_time", "commute_estimated",
+                 "rejected", "minhash", "duplicate_of", "deferred")
+
+    def __init__(self, cl_id, url, name, price, created, where, geotag, area,
+                 repost_of=None):
+        """
+        Initializes an instance of this class.
+        :param cl_id: The Craigslist id.
+        :param url: The link of the listing.
+        :param name: The title of the listing.
+        :param price: The price as a float, or None if unknown.
+        :param created: The datetime the listing was posted.
+        :param where: The neighborhood description written by the poster.
+        :param geotag: A tuple of (lat, lon), or None.
+        :param area: The Craigslist area the listing was found in.
+        :param repost_of: The id of the listing Craigslist says this one
+        reposts, or None.
+        """
+        self.cl_id = cl_id
+        self.url = url
+        self.name = name
+        self.price = price
+        self.created = created
+        self.where = where
+        self.geotag = geotag
+        self.area = area
+        self.repost_of = repost_of
+        self.lat = None
+        self.lon = None
+        self.commute_time = None
+        self.commute_estimated = False
+        self.rejected = False
+        self.minhash = None
+        self.duplicate_of = None
+        self.deferred = None
+
+    @classmethod
+    def from_result(cls, result, area):
+        """
+        Builds a record from a python-craigslist result.
+        :param result: The result dictionary from Craigslist.
+        :param area: The Craigslist area the listing was found in.
+        :return: The ListingRecord.
+        """
+        geotag = result.get("geotag")
+        repost_of = result.get("repost_of")
+        return cls(cl_id=int(result["id"]),
+                   url=result["url"],
+                   name=result["name"],
+                   price=parse_price(result.get("price")),
+                   created=parse_datetime(result["datetime"]),
+                   where=result.get("where"),
+                   geotag=tuple(geotag) if geotag else None,
+                   area=area,
+                   repost_of=int(repost_of) if repost_of else None)
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Builds a record from a stored listing.
+        :param row: The Listing row.
+        :return: The ListingRecord.
+        """
+        geotag = None
+        if row.geotag:
+            geotag = tuple(float(value) for value in row.geotag.split(","))
+        listing = cls(cl_id=row.cl_id,
+                      url=row.link,
+                      name=row.name,
+                      price=row.price,
+                      created=row.created,
+                      where=row.location,
+                      geotag=geotag,
+                      area=row.area)
+        listing.lat = row.lat
+        listing.lon = row.lon
+        listing.commute_time = row.commute_time
+        listing.commute_estimated = bool(row.commute_estimated)
+        listing.duplicate_of = row.duplicate_of
+        return listing
+
+    def to_row(self):
+        """
+        Converts the record to a row of the listings table, without going
+        through an ORM object.
+        :return: A dictionary of column names to values.
+        """
+        return {
+            "link": self.url,
+            "created": self.created,
+            "geotag": "{},{}".format(*self.geotag) if self.geotag else None,
+            "lat": self.lat,
+            "lon": self.lon,
+            "name": self.name,
+            "price": self.price,
+            "location": self.where,
+            "cl_id": self.cl_id,
+            "area": self.area,
+            "commute_time": self.commute_time,
+            "commute_estimated": self.commute_estimated,
+            "duplicate_of": self.duplicate_of,
+            "minhash": encode_signature(self.minhash) if self.minhash else None
+        }
+
+
+def encode_signature(signature):
+    """
+    Encodes a MinHash signature for the minhash column of the listings table.
+    :param signature: A list of integers.
+    :return: A string of comma-separated hexadecimal values.
+    """
+    return ",".join("{:x}".format(value) for value in signature)
+
+
+def decode_signature(encoded):
+    """
+    Decodes a signature stored by encode_signature.
+    :param encoded: The encoded signature.
+    :return: A list of integers.
+    """
+    return [int(value, 16) for value in encoded.split(",")]
+
+
+def parse_price(price):
+    """
+    Parses a Craigslist price such as "$1,500".
+    :param price: The price string.
+    :return: The price as a float, or None if it can't be parsed.
+    """
+    try:
+        return float(price.replace("$", "").replace(",", ""))
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+def parse_datetime(text):
+    """
+    Parses the time a listing was posted. Craigslist uses one format, which
+    is parsed directly; anything else falls back to dateutil, imported only
+    then since it is slow to import.
+    :param text: The datetime string, such as "2017-01-09 18:30".
+    :return: The datetime.
+    """
+    try:
+        return datetime.datetime.strptime(text, "%Y-%m-%d %H:%M")
+    except ValueError:
+        from dateutil.parser import parse
+        return parse(text)
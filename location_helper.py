@@ -1,11 +1,163 @@
 import settings
-import math
 import re
-import requests
-import json
+import time
+import threading
+import functools
+import numpy as np
+import metrics
+from cache import TieredCache
+from api_budget import ApiBudget
+from text_matcher import PhraseMatcher
+from spatial_index import BoxGridIndex, StationKDTree
 
 GMAPS_GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
 GMAPS_DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json"
+GMAPS_DISTANCE_MATRIX_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+
+# The Distance Matrix API accepts at most 25 origins per request
+GMAPS_MATRIX_MAX_ORIGINS = 25
+
+# The statuses of a failed request that may succeed if asked again later
+GMAPS_RETRYABLE_STATUSES = ("OVER_DAILY_LIMIT", "OVER_QUERY_LIMIT", "REQUEST_DENIED",
+                            "UNKNOWN_ERROR")
+
+class RateLimiter:
+    """
+    Spaces out calls so that no more than a given number start per second.
+    """
+    def __init__(self, qps):
+        """
+        Initializes an instance of this class.
+        :param qps: The maximum number of calls per second.
+        """
+        self.interval = 1.0 / qps if qps > 0 else 0
+        self._lock = threading.Lock()
+        self._next_call_time = 0
+
+    def acquire(self):
+        """
+        Waits until the next call is allowed.
+        """
+        # Reserve the next slot, then wait for it outside the lock
+        with self._lock:
+            now = time.time()
+            wait = max(0, self._next_call_time - now)
+            self._next_call_time = now + wait + self.interval
+        time.sleep(wait)
+
+# A keep-alive connection pool shared by every Google Maps call, created on
+# first use so importing this module doesn't import requests
+_http_session = None
+_http_session_lock = threading.Lock()
+gmaps_rate_limiter = RateLimiter(settings.GMAPS_MAX_QPS)
+
+# The budget of calls, shared by every worker process
+gmaps_budget = ApiBudget(settings.API_BUDGET_DB_PATH, settings.GMAPS_BUDGETS,
+                         settings.GMAPS_BUDGET_RESERVE)
+
+def get_http_session():
+    """
+    Gets the connection pool shared by every Google Maps call, creating it
+    on first use.
+    :return: The requests Session.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            _http_session = requests.Session()
+            _http_session.mount("https://", requests.adapters.HTTPAdapter(
+                pool_connections=settings.GMAPS_POOL_SIZE,
+                pool_maxsize=settings.GMAPS_POOL_SIZE))
+        return _http_session
+
+def gmaps_request(endpoint, url, params, cost=1):
+    """
+    Makes a GET request to a Google Maps API. Requests are rate limited, timed
+    out, and retried with exponential backoff on OVER_QUERY_LIMIT, server
+    errors and connection errors. Every attempt is taken from the budget.
+    :param endpoint: The name of the endpoint, used to label the metrics and
+    the budget.
+    :param url: The URL of the endpoint.
+    :param params: The query parameters.
+    :param cost: The number of calls the request counts as against the budget.
+    :return: The decoded JSON response. The status is UNKNOWN_ERROR if every
+    attempt failed without a response, or OVER_DAILY_LIMIT if the budget is
+    spent.
+    """
+    import requests
+    http_session = get_http_session()
+    results = {"status": "UNKNOWN_ERROR"}
+    for attempt in range(settings.GMAPS_MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(settings.GMAPS_BACKOFF_BASE * 2 ** (attempt - 1))
+
+        if not gmaps_budget.acquire(endpoint, cost, settings.GMAPS_BUDGET_MAX_WAIT):
+            print("Warning: The budget of {} is spent.".format(endpoint))
+            metrics.increment("gmaps_requests_total", endpoint=endpoint, status="OVER_BUDGET")
+            return {"status": "OVER_DAILY_LIMIT"}
+
+        gmaps_rate_limiter.acquire()
+        start = time.time()
+        try:
+            response = http_session.get(url, params=params,
+                                        timeout=(settings.GMAPS_CONNECT_TIMEOUT,
+                                                 settings.GMAPS_READ_TIMEOUT))
+        except requests.RequestException as exc:
+            print("Warning: Request to {} failed: {}".format(endpoint, exc))
+            metrics.increment("gmaps_requests_total", endpoint=endpoint, status="CONNECTION_ERROR")
+            continue
+        finally:
+            metrics.observe("gmaps_request_seconds", time.time() - start, endpoint=endpoint)
+
+        # Retry on server errors
+        if response.status_code >= 500:
+            print("Warning: Request to {} returned {}.".format(endpoint, response.status_code))
+            metrics.increment("gmaps_requests_total", endpoint=endpoint,
+                              status="HTTP_{}".format(response.status_code))
+            continue
+
+        results = response.json()
+        metrics.increment("gmaps_requests_total", endpoint=endpoint,
+                          status=results.get('status', 'UNKNOWN'))
+        if results.get('status') != 'OVER_QUERY_LIMIT':
+            break
+
+    return results
+
+# Geocode results keyed on the normalized address text
+geocode_cache = TieredCache(settings.CACHE_DB_PATH,
+                            "geocode_cache",
+                            settings.CACHE_MEMORY_SIZE,
+                            settings.GEOCODE_CACHE_TTL,
+                            settings.GEOCODE_NEGATIVE_CACHE_TTL)
+
+# Travel times keyed on the snapped origin, destination, mode and departure time
+commute_cache = TieredCache(settings.CACHE_DB_PATH,
+                            "commute_cache",
+                            settings.CACHE_MEMORY_SIZE,
+                            settings.COMMUTE_CACHE_TTL,
+                            settings.COMMUTE_NEGATIVE_CACHE_TTL)
+
+# Spatial indexes over the neighborhood boxes and transit stations
+box_index = BoxGridIndex(settings.BOXES)
+station_index = StationKDTree(settings.TRANSIT_STATIONS)
+
+# Matches the neighborhood names in the where field of a listing
+neighborhood_matcher = PhraseMatcher(settings.NEIGHBORHOODS)
+
+# Splits the where field of a listing into locations
+LOCATION_SEPARATOR_RE = re.compile(r"[^\w\s']")
+
+# Station names and coordinates as arrays for the batch distance functions
+station_names = list(settings.TRANSIT_STATIONS)
+station_coords = np.array([settings.TRANSIT_STATIONS[name] for name in station_names],
+                          dtype=float).reshape(-1, 2)
+
+# The radius of the earth used for distances, in kilometers
+EARTH_RADIUS_KM = 6367
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
 
 def get_travel_time(src_geocode, dst_geocode, mode="transit"):
     """
@@ -20,6 +172,12 @@ def get_travel_time(src_geocode, dst_geocode, mode="transit"):
         print("Warning: The source or destination location is not well defined.")
         return 0
 
+    # Return the cached travel time if a nearby origin was looked up before
+    key = commute_cache_key(src_geocode, dst_geocode, mode)
+    found, duration = commute_cache.lookup(key)
+    if found:
+        return -1 if duration is None else duration
+
     # Prepare the parameters and make a GET requests to the API
     params = {
         'key': settings.GMAPS_API_KEY,
@@ -28,8 +186,11 @@ def get_travel_time(src_geocode, dst_geocode, mode="transit"):
         'departure_time': settings.TRANSIT_DEPARTURE_TIME,
         'mode': mode
     }
-    response = requests.get(GMAPS_DIRECTIONS_URL, params=params)
-    results = json.loads(response.text)
+    results = gmaps_request("directions", GMAPS_DIRECTIONS_URL, params)
+
+    # Remember origins without any route so we don't ask again
+    if results['status'] in ('ZERO_RESULTS', 'NOT_FOUND'):
+        commute_cache.store(key, None)
 
     # Return the default value if status returned is not 'OK'
     if results['status'] != 'OK':
@@ -37,41 +198,228 @@ def get_travel_time(src_geocode, dst_geocode, mode="transit"):
         return -1
 
     # Get the first route and calculate the total duration
-    route = json.loads(response.text)['routes'][0]
+    route = results['routes'][0]
     total_duration = 0
     for leg in route['legs']:
         total_duration += leg['duration']['value']
+    commute_cache.store(key, total_duration)
     return total_duration
 
+def get_travel_times(src_geocodes, dst_geocode, mode="transit", cached_only=False):
+    """
+    Gets the travel times of many origins to one destination using the
+    Google Maps Distance Matrix API. Cached origins are answered locally and
+    the rest are resolved in as few requests as possible.
+    :param src_geocodes: A list of (lat, lon) tuples.
+    :param dst_geocode: A tuple of (lat, lon).
+    :param mode: The mode of transport. Default to "transit".
+    :param cached_only: Whether to only answer from the cache, to save the
+    API budget.
+    :return: A list of travel times in seconds, in the order of the origins.
+    A time is None if it was not looked up for lack of budget, or the lookup
+    failed and may succeed later.
+    """
+    # Data validation
+    if dst_geocode is None:
+        print("Warning: The destination location is not well defined.")
+        return [None] * len(src_geocodes)
+
+    durations = [0] * len(src_geocodes)
+
+    # Answer from the cache, grouping the remaining origins by cache key
+    pending = {}
+    for index, src_geocode in enumerate(src_geocodes):
+        if src_geocode is None:
+            print("Warning: The source location is not well defined.")
+            continue
+
+        key = commute_cache_key(src_geocode, dst_geocode, mode)
+        if key in pending:
+            pending[key][1].append(index)
+            continue
+
+        found, duration = commute_cache.lookup(key)
+        if found:
+            durations[index] = -1 if duration is None else duration
+        elif cached_only:
+            durations[index] = None
+        else:
+            pending[key] = (src_geocode, [index])
+
+    # Resolve the uncached origins in chunks
+    keys = list(pending)
+    for start in range(0, len(keys), GMAPS_MATRIX_MAX_ORIGINS):
+        chunk = keys[start:start + GMAPS_MATRIX_MAX_ORIGINS]
+        origins = [pending[key][0] for key in chunk]
+        for key, duration in zip(chunk, _get_matrix_durations(origins, dst_geocode, mode)):
+            for index in pending[key][1]:
+                durations[index] = duration
+
+    return durations
+
+def _get_matrix_durations(src_geocodes, dst_geocode, mode):
+    """
+    Makes one Distance Matrix request and caches every element.
+    :param src_geocodes: A list of at most 25 (lat, lon) tuples.
+    :param dst_geocode: A tuple of (lat, lon).
+    :param mode: The mode of transport.
+    :return: A list of travel times in seconds, -1 where there is no route,
+    or None for every origin if the budget is spent or the request failed
+    and may succeed later.
+    """
+    # Prepare the parameters and make a GET requests to the API
+    params = {
+        'key': settings.GMAPS_API_KEY,
+        'origins': '|'.join('{},{}'.format(src[0], src[1]) for src in src_geocodes),
+        'destinations': '{},{}'.format(dst_geocode[0], dst_geocode[1]),
+        'departure_time': settings.TRANSIT_DEPARTURE_TIME,
+        'mode': mode
+    }
+    results = gmaps_request("distancematrix", GMAPS_DISTANCE_MATRIX_URL, params,
+                            cost=len(src_geocodes))
+
+    # Return the default value for every origin if the request failed, and
+    # leave the origins for later if it may succeed then
+    if results['status'] != 'OK':
+        print('Warning: Status <{}> is not OK.'.format(results['status']))
+        if results['status'] in GMAPS_RETRYABLE_STATUSES:
+            return [None] * len(src_geocodes)
+        return [-1] * len(src_geocodes)
+
+    # Each row holds the single element for our one destination
+    durations = []
+    for src_geocode, row in zip(src_geocodes, results['rows']):
+        element = row['elements'][0]
+        key = commute_cache_key(src_geocode, dst_geocode, mode)
+        if element['status'] == 'OK':
+            commute_cache.store(key, element['duration']['value'])
+            durations.append(element['duration']['value'])
+            continue
+
+        # Remember origins without any route so we don't ask again
+        if element['status'] in ('ZERO_RESULTS', 'NOT_FOUND'):
+            commute_cache.store(key, None)
+        print('Warning: Element status <{}> is not OK.'.format(element['status']))
+        durations.append(-1)
+
+    # Origins missing from the response have no known route
+    durations += [-1] * (len(src_geocodes) - len(durations))
+    return durations
+
+def commute_cache_key(src_geocode, dst_geocode, mode):
+    """
+    Builds the commute cache key. Both ends are snapped to a geohash cell so
+    listings a block apart share the same travel time.
+    :param src_geocode: A tuple of (lat, lon).
+    :param dst_geocode: A tuple of (lat, lon).
+    :param mode: The mode of transport.
+    :return: The cache key.
+    """
+    precision = settings.COMMUTE_CACHE_PRECISION
+    return "{}|{}|{}|{}".format(
+        geohash_encode(src_geocode[0], src_geocode[1], precision),
+        geohash_encode(dst_geocode[0], dst_geocode[1], precision),
+        mode,
+        settings.TRANSIT_DEPARTURE_TIME)
+
+def geohash_encode(lat, lon, precision):
+    """
+    Encodes a coordinate into a geohash string.
+    :param lat: The latitude.
+    :param lon: The longitude.
+    :param precision: The number of characters in the geohash.
+    :return: The geohash of the cell containing the coordinate.
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        value, value_range = (lon, lon_range) if even else (lat, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+
+        # Every 5 bits make one character
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(geohash)
+
 def get_geocode(location):
     """
     Gets the geocode of the location using Google Maps Geocode API.
     :param location: The string of location.
-    :return: A tuple of (lat, lon)
+    :return: A tuple of (lat, lon), (0, 0) if the location was not found, or
+    None if the lookup failed and may succeed later.
     """
     # Data validation
     if location is None or not location:
         print("Warning: Location is not valid.")
         return (0, 0)
-    
+
+    # Return the cached geocode if the address was looked up before
+    key = normalize_address(location)
+    found, geocode = geocode_cache.lookup(key)
+    if found:
+        return (0, 0) if geocode is None else tuple(geocode)
+
     # Create a GET request to the Google Maps API and get the results
     params = {
         "key": settings.GMAPS_API_KEY,
         "address": location
     }
-    response = requests.get(GMAPS_GEOCODE_URL, params=params)
-    results = json.loads(response.text)
+    results = gmaps_request("geocode", GMAPS_GEOCODE_URL, params)
+
+    # Remember addresses that do not exist so we don't ask again
+    if results['status'] == 'ZERO_RESULTS':
+        geocode_cache.store(key, None)
 
     # Return default value if status returned is not 'OK'
     if results['status'] != 'OK':
         print('Warning: Status <{}> is not OK.'.format(results['status']))
-        return (0, 0)
+        return None if results['status'] in GMAPS_RETRYABLE_STATUSES else (0, 0)
 
     # Get the first location result from the response
-    result = json.loads(response.text)['results'][0]
+    result = results['results'][0]
     location = result['geometry']['location']
+    geocode_cache.store(key, [location['lat'], location['lng']])
     return (location['lat'], location['lng'])
 
+def get_geocodes(locations):
+    """
+    Gets the geocodes of many locations, looking up each distinct address
+    only once.
+    :param locations: An iterable of location strings.
+    :return: A dictionary of locations to their result from get_geocode.
+    """
+    by_address = {}
+    geocodes = {}
+    for location in locations:
+        key = normalize_address(location) if location else location
+        if key not in by_address:
+            by_address[key] = get_geocode(location)
+        geocodes[location] = by_address[key]
+    return geocodes
+
+def normalize_address(location):
+    """
+    Normalizes the address text so the same place maps to one cache key.
+    :param location: The string of location.
+    :return: The lowercase location with collapsed whitespace.
+    """
+    return " ".join(location.lower().split())
+
 def parse_locations(locations_str):
     """
     Parses the locations string into a list of locations.
@@ -83,8 +431,17 @@ def parse_locations(locations_str):
         print("Warning: The locations string is not well defined.")
         return []
 
+    return list(_parse_locations(locations_str))
+
+@functools.lru_cache(maxsize=settings.CACHE_MEMORY_SIZE)
+def _parse_locations(locations_str):
+    """
+    Parses the locations string, caching the result of each string.
+    :param locations_str: The string of locations.
+    :return: A tuple of locations in lowercase.
+    """
     # Parse the locations using special characters
-    raw_locations = re.split(r"[^\w\s']", locations_str)
+    raw_locations = LOCATION_SEPARATOR_RE.split(locations_str)
 
     # Filter out the location that is empty
     locations = []
@@ -93,7 +450,7 @@ def parse_locations(locations_str):
         if location:
             locations.append(location.lower())
 
-    return locations
+    return tuple(locations)
 
 def coord_distance(lat1, lon1, lat2, lon2):
     """
@@ -104,13 +461,43 @@ def coord_distance(lat1, lon1, lat2, lon2):
     :param lon2: Point two longitude.
     :return: Kilometer distance.
     """
-    lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
+    return float(coord_distances([lat1], [lon1], [lat2], [lon2])[0, 0])
+
+def coord_distances(lats1, lons1, lats2, lons2):
+    """
+    Finds the distances between every point of one batch and every point of
+    another batch.
+    :param lats1: An array of the latitudes of the first batch.
+    :param lons1: An array of the longitudes of the first batch.
+    :param lats2: An array of the latitudes of the second batch.
+    :param lons2: An array of the longitudes of the second batch.
+    :return: A matrix of kilometer distances, with one row per point of the
+    first batch and one column per point of the second batch.
+    """
+    lat1 = np.radians(np.asarray(lats1, dtype=float))[:, np.newaxis]
+    lon1 = np.radians(np.asarray(lons1, dtype=float))[:, np.newaxis]
+    lat2 = np.radians(np.asarray(lats2, dtype=float))[np.newaxis, :]
+    lon2 = np.radians(np.asarray(lons2, dtype=float))[np.newaxis, :]
     dlon = lon2 - lon1
     dlat = lat2 - lat1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    km = 6367 * c
-    return km
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    return EARTH_RADIUS_KM * c
+
+def nearest_stations(lats, lons):
+    """
+    Finds the nearest transit station of every point in a batch.
+    :param lats: An array of latitudes.
+    :param lons: An array of longitudes.
+    :return: A tuple of (station indices into station_names, kilometer
+    distances), or None if there are no stations.
+    """
+    if not station_names:
+        return None
+
+    distances = coord_distances(lats, lons, station_coords[:, 0], station_coords[:, 1])
+    indices = np.argmin(distances, axis=1)
+    return indices, distances[np.arange(len(indices)), indices]
 
 def in_box(coords, box):
     """
@@ -119,9 +506,65 @@ def in_box(coords, box):
     :param box: Two tuples, where first is the bottom left, and the second is the top right of the box.
     :return: Boolean indicating if the coordinates are in the box.
     """
-    if box[0][0] < coords[0] < box[1][0] and box[1][1] < coords[1] < box[0][1]:
-        return True
-    return False
+    return bool(in_boxes([coords[0]], [coords[1]], [box])[0, 0])
+
+def in_boxes(lats, lons, boxes):
+    """
+    Finds which boxes contain each point of a batch.
+    :param lats: An array of latitudes.
+    :param lons: An array of longitudes.
+    :param boxes: A list of boxes, in the format of in_box.
+    :return: A boolean mask with one row per point and one column per box.
+    """
+    lats = np.asarray(lats, dtype=float)[:, np.newaxis]
+    lons = np.asarray(lons, dtype=float)[:, np.newaxis]
+    bounds = np.array(boxes, dtype=float).reshape(-1, 4)
+    return ((bounds[:, 0] < lats) & (lats < bounds[:, 2]) &
+            (bounds[:, 3] < lons) & (lons < bounds[:, 1]))
+
+def find_boxes(lats, lons):
+    """
+    Finds the neighborhood box of every point in a batch. When boxes overlap,
+    the last one in settings.BOXES wins.
+    :param lats: An array of latitudes.
+    :param lons: An array of longitudes.
+    :return: A list with the box name of each point, or None outside all boxes.
+    """
+    names = list(settings.BOXES)
+    if not names:
+        return [None] * len(lats)
+
+    mask = in_boxes(lats, lons, [settings.BOXES[name] for name in names])
+    last = len(names) - 1 - np.argmax(mask[:, ::-1], axis=1)
+    return [names[index] if mask[row, index] else None
+            for row, index in enumerate(last)]
+
+def nearest_station(lat, lon):
+    """
+    Finds the transit station nearest to a coordinate.
+    :param lat: The latitude.
+    :param lon: The longitude.
+    :return: A tuple of (station name, kilometer distance), or None if there
+    are no stations.
+    """
+    nearest = station_index.nearest(lat, lon)
+    if nearest is None:
+        return None
+
+    station, coords = nearest
+    return station, coord_distance(coords[0], coords[1], lat, lon)
+
+@functools.lru_cache(maxsize=settings.CACHE_MEMORY_SIZE)
+def find_neighborhood(location):
+    """
+    Finds the neighborhood named in a location string. The longest name wins,
+    so "berkeley north" is preferred over "berkeley".
+    :param location: The where field of a Craigslist result.
+    :return: The neighborhood from settings.NEIGHBORHOODS, or None.
+    """
+    if not location:
+        return None
+    return neighborhood_matcher.find_longest(location)
 
 def find_points_of_interest(geotag, location):
     """
@@ -133,32 +576,27 @@ def find_points_of_interest(geotag, location):
     """
     area_found = False
     area = ""
-    min_dist = None
     near_bart = False
     bart_dist = "N/A"
     bart = ""
     # Look to see if the listing is in any of the neighborhood boxes we defined.
-    for a, coords in settings.BOXES.items():
-        if in_box(geotag, coords):
-            area = a
-            area_found = True
+    box = box_index.find(geotag)
+    if box is not None:
+        area = box
+        area_found = True
 
     # Check to see if the listing is near any transit stations.
-    for station, coords in settings.TRANSIT_STATIONS.items():
-        dist = coord_distance(coords[0], coords[1], geotag[0], geotag[1])
-        if (min_dist is None or dist < min_dist) and dist < settings.MAX_TRANSIT_DIST:
+    nearest = nearest_station(geotag[0], geotag[1])
+    if nearest is not None:
+        station, bart_dist = nearest
+        if bart_dist < settings.MAX_TRANSIT_DIST:
             bart = station
             near_bart = True
 
-        if (min_dist is None or dist < min_dist):
-            bart_dist = dist
-
     # If the listing isn't in any of the boxes we defined, check to see if the string description of the neighborhood
     # matches anything in our list of neighborhoods.
     if len(area) == 0:
-        for hood in settings.NEIGHBORHOODS:
-            if hood in location.lower():
-                area = hood
+        area = find_neighborhood(location) or ""
 
     return {
         "area_found": area_found,
@@ -1,16 +1,29 @@
-from scraper import Scraper
-from condition import LocationCondition
+from scraper import Scraper, get_arrival_rates, is_rate_limited
+from scheduler import AreaScheduler
+from retention import start_retention_worker
+from job_queue import JobQueue, job_key
+from slack_queue import SlackQueue
+from condition import LocationCondition, CommuteCondition
+import metrics
 import settings
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
 import time
 import sys
 import traceback
 
-if "__main__" == __name__:
-    # Define areas to search for with accompanying filters
-    areas_filters_dict = {
-        "see": {"max_price": 800, "min_price": 400}
-    }
-
+def create_scraper(site, category, areas_filters_dict, deliver_slack=True):
+    """
+    Creates a scraper with the filtering conditions.
+    :param site: The Craigslist site to search.
+    :param category: The category of the housing search.
+    :param areas_filters_dict: A dictionary of areas with filters to search.
+    :param deliver_slack: Whether the scraper drains the Slack queue.
+    :return: The Scraper.
+    """
     # Define slack settings
     slack_settings = {
         "slack_token": settings.SLACK_TOKEN,
@@ -18,25 +31,269 @@ if "__main__" == __name__:
     }
 
     # Initialize scraper
-    scraper = Scraper(site="seattle",
-                      category="roo",
+    scraper = Scraper(site=site,
+                      category=category,
                       areas_filters_dict=areas_filters_dict,
-                      slack_settings=slack_settings)
+                      slack_settings=slack_settings,
+                      deliver_slack=deliver_slack)
 
     # Initialize filtering conditions
     scraper.add_condition(LocationCondition())
+    if settings.MAX_COMMUTE_TIME is not None:
+        scraper.add_condition(CommuteCondition(settings.MAX_COMMUTE_TIME))
+    return scraper
+
+def create_scheduler(keys, initial_interval):
+    """
+    Creates the scheduler deciding when each shard is scraped.
+    :param keys: A list of shard keys.
+    :param initial_interval: The interval in seconds used until the arrival
+    rate of a shard is known.
+    :return: The AreaScheduler.
+    """
+    return AreaScheduler(keys,
+                         initial_interval=initial_interval,
+                         min_interval=settings.SCHEDULER_MIN_INTERVAL,
+                         max_interval=settings.SCHEDULER_MAX_INTERVAL,
+                         target_new_listings=settings.SCHEDULER_TARGET_NEW_LISTINGS,
+                         jitter=settings.SCHEDULER_JITTER,
+                         max_backoff=settings.SCHEDULER_MAX_BACKOFF)
+
+def scrape_areas(scraper, areas):
+    """
+    Scrapes areas of one scraper.
+    :param scraper: The Scraper.
+    :param areas: A list of areas to scrape.
+    :return: A tuple of (failures, rates): a dictionary of the areas that
+    failed to the exception raised, and a dictionary of areas to their
+    arrival rate of new listings.
+    """
+    try:
+        failures = scraper.scrape(areas)
+        rates = get_arrival_rates(areas, settings.SCHEDULER_ARRIVAL_WINDOW)
+    except Exception as exc:
+        print("Error with the scraping:", sys.exc_info()[0])
+        traceback.print_exc()
+        return dict((area, exc) for area in areas), {}
+
+    print("{}: Successfully finished scraping".format(time.ctime()))
+    return failures, rates
+
+def record_result(scheduler, key, area, failures, rates):
+    """
+    Plans the next run of a shard from the result of its scrape.
+    :param scheduler: The AreaScheduler.
+    :param key: The key of the shard.
+    :param area: The area of the shard.
+    :param failures: The failures returned by scrape_areas.
+    :param rates: The arrival rates returned by scrape_areas.
+    """
+    if area in failures:
+        scheduler.record_failure(key, is_rate_limited(failures[area]))
+    else:
+        scheduler.record_success(key, rates[area])
+
+def create_slack_queue():
+    """
+    Creates the queue posting the matching listings to Slack, and starts
+    delivering them. Only one queue drains the outbox, so no message is
+    posted twice.
+    :return: The SlackQueue.
+    """
+    from slackclient import SlackClient
+    slack_queue = SlackQueue(SlackClient(settings.SLACK_TOKEN),
+                             settings.SLACK_QUEUE_DB_PATH,
+                             settings.SLACK_QUEUE_BATCH_SIZE,
+                             settings.SLACK_CHANNEL_INTERVAL,
+                             settings.SLACK_QUEUE_POLL_INTERVAL,
+                             settings.SLACK_MAX_ATTEMPTS)
+    slack_queue.start()
+    return slack_queue
+
+def run_single_process():
+    """
+    Scrapes every search from this process.
+    """
+    # Create a scraper per search, and find the shards of each. The scrapers
+    # share one Slack queue rather than each draining the outbox.
+    scrapers = {}
+    shards = {}
+    for search in settings.SEARCHES:
+        site, category = search["site"], search["category"]
+        scrapers[(site, category)] = create_scraper(site, category, search["areas"],
+                                                    deliver_slack=False)
+        for area in search["areas"]:
+            shards[job_key(site, category, area)] = (site, category, area)
+
+    create_slack_queue()
+
+    # Archive old listings in the background
+    start_retention_worker()
+
+    # Serve the metrics for scraping by Prometheus
+    if settings.METRICS_PORT:
+        metrics.start_http_server(settings.METRICS_PORT)
+
+    # Initialize the scheduler deciding when each area is scraped
+    scheduler = create_scheduler(list(shards), settings.SLEEP_INTERVAL)
 
     # Main loop to scrape info and post new matching listings
     while True:
-        print("{}: Starting scrape cycle".format(time.ctime()))
+        keys = scheduler.due_areas()
+        if keys:
+            print("{}: Starting scrape cycle for {}".format(time.ctime(), ", ".join(keys)))
+
+            # Scrape the due areas of each search together
+            due = {}
+            for key in keys:
+                site, category, area = shards[key]
+                due.setdefault((site, category), []).append(area)
+            for search, areas in due.items():
+                failures, rates = scrape_areas(scrapers[search], areas)
+
+                # Plan the next run of each area from its arrival rate
+                for area in areas:
+                    record_result(scheduler, job_key(search[0], search[1], area),
+                                  area, failures, rates)
+
+            for key, next_run in sorted(scheduler.next_run_times().items()):
+                print("{}: Next scrape of {} at {}".format(time.ctime(), key, time.ctime(next_run)))
+
+        time.sleep(scheduler.seconds_until_next_run())
+
+def renew_lease(queue, key, owner, stopped):
+    """
+    Renews the lease of a job until stopped.
+    :param queue: The JobQueue.
+    :param key: The key of the job.
+    :param owner: The name of the worker holding the lease.
+    :param stopped: An event set once the job is done.
+    """
+    while not stopped.wait(settings.JOB_LEASE_DURATION / 3):
+        if not queue.renew(key, owner, settings.JOB_LEASE_DURATION):
+            print("Warning: Lost the lease of {}.".format(key))
+            return
+
+def run_worker(name=None):
+    """
+    Leases jobs from the shared queue and scrapes them, one at a time.
+    :param name: A unique name of the worker. Defaults to the host name and
+    process id.
+    """
+    name = name or "{}-{}".format(socket.gethostname(), os.getpid())
+    queue = JobQueue(settings.JOB_QUEUE_DB_PATH)
+
+    print("{}: Worker {} started".format(time.ctime(), name))
+    scrapers = {}
+    while True:
+        job = queue.lease(name, settings.JOB_LEASE_DURATION)
+        if job is None:
+            wait = queue.seconds_until_next_job()
+            time.sleep(settings.JOB_POLL_INTERVAL if wait is None
+                       else min(wait, settings.JOB_POLL_INTERVAL))
+            continue
+
+        # Only the coordinator posts to Slack, so no message is posted twice
+        search = (job["site"], job["category"])
+        if search not in scrapers:
+            scrapers[search] = create_scraper(job["site"], job["category"], {},
+                                              deliver_slack=False)
+
+            # Each worker writes its own metrics file
+            if settings.METRICS_FILE:
+                root, extension = os.path.splitext(settings.METRICS_FILE)
+                scrapers[search].metrics_file = "{}-{}{}".format(root, name, extension)
+        scraper = scrapers[search]
+        if job["area"] not in scraper.cl_clients:
+            scraper.add_area(job["area"], job["filters"])
+
+        print("{}: Worker {} scraping {}".format(time.ctime(), name, job["key"]))
+        stopped = threading.Event()
+        renewer = threading.Thread(target=renew_lease,
+                                   args=(queue, job["key"], name, stopped),
+                                   daemon=True)
+        renewer.start()
         try:
-            scraper.scrape()
-        except KeyboardInterrupt:
-            print("Exiting....")
-            sys.exit(1)
-        except Exception as exc:
-            print("Error with the scraping:", sys.exc_info()[0])
-            traceback.print_exc()
+            failures, rates = scrape_areas(scraper, [job["area"]])
+        finally:
+            stopped.set()
+            renewer.join()
+
+        # Plan the next run from the shard's own history
+        scheduler = create_scheduler([job["key"]], job["interval"] or settings.SLEEP_INTERVAL)
+        state = scheduler.areas[job["key"]]
+        state["errors"] = job["errors"]
+        record_result(scheduler, job["key"], job["area"], failures, rates)
+        if not queue.complete(job["key"], name, state["next_run"], state["interval"],
+                              state["errors"]):
+            print("Warning: Lost the lease of {} before it finished.".format(job["key"]))
+
+def worker_process():
+    """
+    The entry point of a worker process started by the coordinator.
+    """
+    try:
+        run_worker()
+    except KeyboardInterrupt:
+        pass
+
+def run_coordinator(processes):
+    """
+    Queues a job for every (site, category, area) shard of the searches, and
+    keeps a pool of worker processes scraping them. The coordinator also
+    posts the queued Slack messages and runs the retention job.
+    :param processes: The number of worker processes.
+    """
+    queue = JobQueue(settings.JOB_QUEUE_DB_PATH)
+    keys = []
+    for search in settings.SEARCHES:
+        for area, filters in search["areas"].items():
+            keys.append(queue.add_job(search["site"], search["category"], area, filters,
+                                      settings.SLEEP_INTERVAL))
+    queue.retain(keys)
+    print("{}: Queued {} jobs".format(time.ctime(), len(keys)))
+
+    create_slack_queue()
+    start_retention_worker()
+    if settings.METRICS_PORT:
+        metrics.start_http_server(settings.METRICS_PORT)
+
+    # Start fresh interpreters rather than forking our database connections
+    context = multiprocessing.get_context("spawn")
+    workers = [None] * processes
+    while True:
+        for index, worker in enumerate(workers):
+            if worker is not None and worker.is_alive():
+                continue
+            if worker is not None:
+                print("Warning: Worker {} exited with {}; restarting it.".format(
+                    worker.name, worker.exitcode))
+            workers[index] = context.Process(target=worker_process,
+                                             name="worker-{}".format(index),
+                                             daemon=True)
+            workers[index].start()
+
+        time.sleep(settings.JOB_POLL_INTERVAL)
+
+if "__main__" == __name__:
+    parser = argparse.ArgumentParser(
+        description="Scrapes Craigslist and posts the matching listings to Slack.")
+    parser.add_argument("mode", nargs="?", default="single",
+                        choices=["single", "coordinator", "worker"],
+                        help="single scrapes every search from this process; coordinator "
+                             "runs a pool of worker processes; worker only scrapes jobs "
+                             "queued by a coordinator, such as from another host")
+    parser.add_argument("--processes", type=int, default=settings.WORKER_PROCESSES,
+                        help="the number of worker processes of the coordinator")
+    args = parser.parse_args()
+
+    try:
+        if args.mode == "coordinator":
+            run_coordinator(args.processes)
+        elif args.mode == "worker":
+            run_worker()
         else:
-            print("{}: Successfully finished scraping".format(time.ctime()))
-        time.sleep(settings.SLEEP_INTERVAL)
+            run_single_process()
+    except KeyboardInterrupt:
+        print("Exiting....")
+        sys.exit(1)
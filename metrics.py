@@ -0,0 +1,213 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    """
+    Counts durations in fixed buckets.
+    """
+    def __init__(self):
+        """
+        Initializes an instance of this class.
+        """
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """
+        Records a duration.
+        :param seconds: The duration in seconds.
+        """
+        bucket = len(BUCKETS)
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                bucket = index
+                break
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+class Registry:
+    """
+    Holds the counters, gauges and timing histograms of the scraper. Each
+    metric is identified by a name and a set of labels.
+    """
+    def __init__(self):
+        """
+        Initializes an instance of this class.
+        """
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        """
+        Adds to a counter.
+        :param name: The name of the counter.
+        :param value: The amount to add.
+        :param labels: The labels of the counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Sets a gauge to the current value of something, such as a budget.
+        :param name: The name of the gauge.
+        :param value: The value.
+        :param labels: The labels of the gauge.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records a duration in a histogram.
+        :param name: The name of the histogram.
+        :param seconds: The duration in seconds.
+        :param labels: The labels of the histogram.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Times a block of code into a histogram.
+        :param name: The name of the histogram.
+        :param labels: The labels of the histogram.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def snapshot(self):
+        """
+        Takes a snapshot of every metric.
+        :return: A JSON-serializable dictionary.
+        """
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            gauges = [{"name": name, "labels": dict(labels), "value": value}
+                      for (name, labels), value in sorted(self.gauges.items())]
+            histograms = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                histograms.append({
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.total,
+                    "max": histogram.max,
+                    "buckets": dict(zip([str(bound) for bound in BUCKETS] + ["+Inf"],
+                                        histogram.counts))
+                })
+        return {"time": time.time(), "counters": counters, "gauges": gauges,
+                "histograms": histograms}
+
+    def to_prometheus(self):
+        """
+        Formats every metric in the Prometheus text format.
+        :return: The metrics text.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for counter in snapshot["counters"] + snapshot["gauges"]:
+            lines.append("{}{} {}".format(counter["name"], _labels(counter["labels"]),
+                                          counter["value"]))
+        for histogram in snapshot["histograms"]:
+            cumulative = 0
+            for bound, count in histogram["buckets"].items():
+                cumulative += count
+                labels = dict(histogram["labels"], le=bound)
+                lines.append("{}_bucket{} {}".format(histogram["name"], _labels(labels), cumulative))
+            lines.append("{}_sum{} {}".format(histogram["name"], _labels(histogram["labels"]),
+                                              histogram["sum"]))
+            lines.append("{}_count{} {}".format(histogram["name"], _labels(histogram["labels"]),
+                                                histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """
+        Writes a JSON snapshot of every metric to a file, replacing it whole
+        so readers never see a partial file.
+        :param path: The path of the file.
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as output:
+            json.dump(self.snapshot(), output, indent=2)
+        os.replace(temp_path, path)
+
+def _labels(labels):
+    """
+    Formats labels for the Prometheus text format.
+    :param labels: A dictionary of labels.
+    :return: The formatted labels, or an empty string without labels.
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                          for key, value in sorted(labels.items())) + "}"
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_http_server(port, registry=None):
+    """
+    Serves the metrics over HTTP from a background thread: /metrics in the
+    Prometheus text format and /metrics.json as JSON.
+    :param port: The port to listen on.
+    :param registry: The registry to serve. Defaults to the global registry.
+    :return: The HTTP server.
+    """
+    registry = registry or globals()["registry"]
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = registry.to_prometheus().encode("utf-8")
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body = json.dumps(registry.snapshot()).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+# The metrics of this process
+registry = Registry()
+increment = registry.increment
+set_gauge = registry.set_gauge
+observe = registry.observe
+timer = registry.timer
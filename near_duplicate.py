@@ -0,0 +1,203 @@
+import hashlib
+import random
+import re
+import location_helper
+import settings
+from listing_record import decode_signature
+from storage import Listing, ListingSignature, session
+
+# Hash coefficients of the MinHash permutations, fixed so signatures stay
+# comparable across runs
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20170109)
+_COEFFICIENTS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME))
+                 for _ in range(settings.MINHASH_PERMUTATIONS)]
+
+_WORD_RE = re.compile(r"\w+")
+_PRICE_RE = re.compile(r"\$\s*[\d,.]+")
+
+def _hash(value):
+    """
+    Hashes a string into a stable 64-bit integer.
+    :param value: The string to hash.
+    :return: A non-negative integer below 2^63.
+    """
+    digest = hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") & 0x7FFFFFFFFFFFFFFF
+
+def shingles(listing):
+    """
+    Builds the set of features compared between listings: word 2-shingles of
+    the title and neighborhood, the price and the rounded coordinates.
+    :param listing: The ListingRecord.
+    :return: A set of strings.
+    """
+    features = set()
+    for field in (listing.name, listing.where):
+        words = _WORD_RE.findall((field or "").lower())
+        features.update(words)
+        features.update(" ".join(words[i:i + 2]) for i in range(len(words) - 1))
+
+    if listing.price is not None:
+        features.add("price:{:.0f}".format(listing.price))
+    if listing.geotag is not None:
+        features.add("geo:" + location_helper.geohash_encode(listing.geotag[0],
+                                                             listing.geotag[1],
+                                                             settings.MINHASH_GEOHASH_PRECISION))
+    return features
+
+def numeric_tokens(name):
+    """
+    Finds the words of a title holding a number, such as "2br" or "850",
+    which tell units of the same building apart. Prices are left out, since
+    a repost may change its price.
+    :param name: The title of the listing, or None.
+    :return: A frozenset of lowercase words.
+    """
+    words = _WORD_RE.findall(_PRICE_RE.sub(" ", (name or "").lower()))
+    return frozenset(word for word in words if any(char.isdigit() for char in word))
+
+def minhash(features):
+    """
+    Computes the MinHash signature of a set of features.
+    :param features: A set of strings.
+    :return: A list of 32-bit integers, one per permutation.
+    """
+    hashes = [_hash(feature) for feature in features] or [0]
+    return [min((a * value + b) % _PRIME for value in hashes) & 0xFFFFFFFF
+            for a, b in _COEFFICIENTS]
+
+def lsh_buckets(signature):
+    """
+    Splits a signature into bands and hashes each band into a bucket. Two
+    listings sharing any bucket are candidate duplicates.
+    :param signature: The MinHash signature.
+    :return: A list of bucket ids, one per band.
+    """
+    rows = len(signature) // settings.MINHASH_BANDS
+    return [_hash("{}:{}".format(band, signature[band * rows:(band + 1) * rows]))
+            for band in range(settings.MINHASH_BANDS)]
+
+def similarity(signature1, signature2):
+    """
+    Estimates the Jaccard similarity of two listings from their signatures.
+    :param signature1: The first MinHash signature.
+    :param signature2: The second MinHash signature.
+    :return: The estimated similarity between 0 and 1.
+    """
+    same = sum(1 for value1, value2 in zip(signature1, signature2) if value1 == value2)
+    return same / len(signature1)
+
+def _same_price(price1, price2):
+    """
+    Checks if two prices are close enough for reposts of the same unit.
+    :param price1: The first price, or None.
+    :param price2: The second price, or None.
+    :return: True if either price is unknown or they are within tolerance.
+    """
+    if price1 is None or price2 is None:
+        return True
+    return abs(price1 - price2) <= settings.MINHASH_PRICE_TOLERANCE * max(price1, price2)
+
+class NearDuplicateDetector:
+    """
+    Finds listings that are reposts of a listing seen before, using MinHash
+    signatures and LSH buckets. Earlier listings are looked up in the
+    listing_signatures table; listings of the current scrape cycle are kept
+    in memory.
+    """
+    def __init__(self):
+        """
+        Initializes an instance of this class.
+        """
+        self.buckets = {}
+        self.listings = {}
+
+    def check(self, listings):
+        """
+        Computes the signatures of a batch of listings and links each repost
+        to its original through duplicate_of.
+        :param listings: A batch of ListingRecords.
+        """
+        for listing in listings:
+            listing.minhash = minhash(shingles(listing))
+
+        # Find the earlier listings sharing a bucket with a single query
+        listing_buckets = dict((listing.cl_id, lsh_buckets(listing.minhash))
+                               for listing in listings)
+        all_buckets = set(bucket for buckets in listing_buckets.values() for bucket in buckets)
+        stored_buckets = {}
+        if all_buckets:
+            rows = session.query(ListingSignature.bucket, ListingSignature.cl_id).filter(
+                ListingSignature.bucket.in_(list(all_buckets))).all()
+            for bucket, cl_id in rows:
+                stored_buckets.setdefault(bucket, set()).add(cl_id)
+
+        # Load the candidates' signatures, prices and titles
+        candidate_ids = set(cl_id for cl_ids in stored_buckets.values() for cl_id in cl_ids)
+        candidates = {}
+        if candidate_ids:
+            rows = session.query(Listing.cl_id, Listing.minhash, Listing.price, Listing.name).filter(
+                Listing.cl_id.in_(list(candidate_ids))).all()
+            for cl_id, encoded, price, name in rows:
+                if encoded:
+                    candidates[cl_id] = (decode_signature(encoded), price, numeric_tokens(name))
+
+        for listing in listings:
+            buckets = listing_buckets[listing.cl_id]
+            best = None
+            for bucket in buckets:
+                for cl_id in stored_buckets.get(bucket, ()):
+                    best = self._better_match(listing, cl_id, candidates.get(cl_id), best)
+                for cl_id in self.buckets.get(bucket, ()):
+                    best = self._better_match(listing, cl_id, self.listings.get(cl_id), best)
+
+            if best is not None:
+                listing.duplicate_of = best[1]
+                continue
+
+            # Only originals are indexed, so reposts link to the first listing
+            self.listings[listing.cl_id] = (listing.minhash, listing.price,
+                                            numeric_tokens(listing.name))
+            for bucket in buckets:
+                self.buckets.setdefault(bucket, []).append(listing.cl_id)
+
+    @staticmethod
+    def _better_match(listing, cl_id, candidate, best):
+        """
+        Compares a listing with a candidate original. Besides a similar
+        signature and price, the numbers in their titles must be the same, so
+        a 1BR and a 2BR of one building are not taken for a repost.
+        :param listing: The ListingRecord being checked.
+        :param cl_id: The id of the candidate.
+        :param candidate: A tuple of (signature, price, numeric title tokens)
+        of the candidate, or None.
+        :param best: The best match so far as (similarity, cl_id), or None.
+        :return: The best match including the candidate.
+        """
+        if candidate is None or cl_id == listing.cl_id:
+            return best
+
+        signature, price, numbers = candidate
+        if numbers != numeric_tokens(listing.name):
+            return best
+        score = similarity(listing.minhash, signature)
+        if score < settings.MINHASH_THRESHOLD or not _same_price(listing.price, price):
+            return best
+        if best is None or score > best[0] or (score == best[0] and cl_id < best[1]):
+            return (score, cl_id)
+        return best
+
+def signature_rows(listings):
+    """
+    Builds the listing_signatures rows of the original listings in a batch.
+    :param listings: A batch of ListingRecords checked by the detector.
+    :return: A list of row dictionaries.
+    """
+    rows = []
+    for listing in listings:
+        if listing.minhash is None or listing.duplicate_of is not None:
+            continue
+        for bucket in lsh_buckets(listing.minhash):
+            rows.append({"cl_id": listing.cl_id, "bucket": bucket})
+    return rows
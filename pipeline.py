@@ -0,0 +1,186 @@
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+# Marks the end of the stream in a queue
+_END = object()
+
+
+class Stage:
+    """
+    A step of a pipeline. The function receives a list of items and returns
+    the items to pass to the next stage.
+    """
+    def __init__(self, name, func, batch_size, workers, linger):
+        """
+        Initializes an instance of this class.
+        :param name: The name of the stage.
+        :param func: The function processing a batch of items.
+        :param batch_size: The most items handed to the function at once.
+        :param workers: The number of threads running the stage.
+        :param linger: The most seconds to wait for a batch to fill.
+        """
+        self.name = name
+        self.func = func
+        self.batch_size = batch_size
+        self.workers = workers
+        self.linger = linger
+
+
+class Pipeline:
+    """
+    Streams items through stages that run in their own threads. Stages are
+    connected by bounded queues, so a slow stage makes the stages before it
+    wait instead of letting items pile up in memory.
+    """
+    def __init__(self, buffer_size, teardown=None):
+        """
+        Initializes an instance of this class.
+        :param buffer_size: The most items waiting between two stages.
+        :param teardown: A function called by every thread before it exits,
+        such as one releasing a thread-local database session.
+        """
+        self.buffer_size = buffer_size
+        self.teardown = teardown
+        self.stages = []
+
+    def add_stage(self, name, func, batch_size=1, workers=1, linger=0):
+        """
+        Adds a stage at the end of the pipeline. A stage takes whatever items
+        are already waiting, up to the batch size, and then waits up to the
+        linger time for more until the batch is full or the stream ends.
+        :param name: The name of the stage.
+        :param func: The function processing a batch of items.
+        :param batch_size: The most items handed to the function at once.
+        :param workers: The number of threads running the stage.
+        :param linger: The most seconds to wait for a batch to fill, such as
+        to make fewer and larger API requests. 0 never waits.
+        :return: The pipeline, so calls can be chained.
+        """
+        self.stages.append(Stage(name, func, batch_size, workers, linger))
+        return self
+
+    def run(self, sources, workers=1):
+        """
+        Runs the pipeline until every source is exhausted and every item went
+        through all the stages. An error in a batch is reported and the other
+        batches keep flowing; the first error is raised once done.
+        :param sources: A list of iterables producing the items.
+        :param workers: The number of sources read concurrently.
+        :return: The number of items coming out of the last stage.
+        """
+        queues = [queue.Queue(maxsize=self.buffer_size) for _ in self.stages]
+        errors = []
+        output_count = [0]
+        threads = [threading.Thread(target=self._feed,
+                                    args=(sources, workers, queues[0], errors),
+                                    name="pipeline-feed")]
+
+        for index, stage in enumerate(self.stages):
+            output = queues[index + 1] if index + 1 < len(queues) else None
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[index], output, remaining, lock, errors, output_count),
+                    name="pipeline-{}".format(stage.name)))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+        return output_count[0]
+
+    def _feed(self, sources, workers, output, errors):
+        """
+        Reads the sources concurrently into the first queue.
+        :param sources: A list of iterables producing the items.
+        :param workers: The number of sources read concurrently.
+        :param output: The queue of the first stage.
+        :param errors: The list collecting errors.
+        """
+        def drain(source):
+            try:
+                for item in source:
+                    output.put(item)
+            except Exception as exc:
+                print("Error with a pipeline source:", exc)
+                traceback.print_exc()
+                errors.append(exc)
+            finally:
+                if self.teardown is not None:
+                    self.teardown()
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                list(executor.map(drain, sources))
+        finally:
+            output.put(_END)
+
+    def _work(self, stage, input, output, remaining, lock, errors, output_count):
+        """
+        Runs one thread of a stage until the end of the stream.
+        :param stage: The stage to run.
+        :param input: The queue of items for the stage.
+        :param output: The queue of the next stage, or None for the last stage.
+        :param remaining: A one-item list counting the running threads of the stage.
+        :param lock: The lock guarding the count of running threads.
+        :param errors: The list collecting errors.
+        :param output_count: A one-item list counting the items out of the pipeline.
+        """
+        try:
+            ended = False
+            while not ended:
+                item = input.get()
+                if item is _END:
+                    break
+
+                # Take whatever else arrives within the linger time, up to the
+                # batch size
+                batch = [item]
+                deadline = time.time() + stage.linger
+                while len(batch) < stage.batch_size:
+                    try:
+                        wait = deadline - time.time()
+                        item = input.get(timeout=wait) if wait > 0 else input.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _END:
+                        ended = True
+                        break
+                    batch.append(item)
+
+                try:
+                    with metrics.timer("pipeline_stage_seconds", stage=stage.name):
+                        results = stage.func(batch) or []
+                    metrics.increment("pipeline_items_total", len(batch), stage=stage.name)
+                except Exception as exc:
+                    print("Error with pipeline stage {}:".format(stage.name), exc)
+                    traceback.print_exc()
+                    errors.append(exc)
+                    continue
+
+                for result in results:
+                    if output is None:
+                        with lock:
+                            output_count[0] += 1
+                    else:
+                        output.put(result)
+        finally:
+            # Let the other threads of the stage see the end of the stream,
+            # and close the stream for the next stage once all are done
+            input.put(_END)
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and output is not None:
+                output.put(_END)
+            if self.teardown is not None:
+                self.teardown()
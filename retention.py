@@ -0,0 +1,162 @@
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+import traceback
+from sqlalchemy import text
+import location_helper
+import settings
+from storage import Listing, ListingSignature, SeenListing, EnrichmentBackfill
+from storage import session, db_lock, get_engine
+
+def archive_old_listings(max_age, archive_dir, batch_size):
+    """
+    Moves the listings older than the maximum age out of the listings table
+    into gzip JSONL files, one per month of creation. Their ids are kept in
+    the seen_listings table so they are never scraped again. Rows are moved
+    in small batches so the scraper is never blocked for long.
+    :param max_age: The age in seconds after which a listing is archived.
+    :param archive_dir: The directory of the archive files.
+    :param batch_size: The number of listings moved per transaction.
+    :return: The number of archived listings.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+
+    archived = 0
+    while True:
+        listings = session.query(Listing).filter(Listing.created < cutoff).order_by(
+            Listing.id).limit(batch_size).all()
+        if not listings:
+            break
+
+        # Append each listing to the partition of its month. Files are
+        # written before the rows are deleted, so nothing is ever lost.
+        partitions = {}
+        for listing in listings:
+            partitions.setdefault(listing.created.strftime("%Y-%m"), []).append(listing)
+        for month, month_listings in partitions.items():
+            path = os.path.join(archive_dir, "listings-{}.jsonl.gz".format(month))
+            with gzip.open(path, "at") as archive:
+                for listing in month_listings:
+                    archive.write(json.dumps(_listing_to_json(listing)) + "\n")
+
+        # Remember the ids and delete the rows in one transaction
+        ids = [listing.id for listing in listings]
+        cl_ids = [listing.cl_id for listing in listings if listing.cl_id is not None]
+        with db_lock:
+            session.bulk_insert_mappings(SeenListing, [{"cl_id": cl_id} for cl_id in cl_ids])
+            session.query(ListingSignature).filter(
+                ListingSignature.cl_id.in_(cl_ids)).delete(synchronize_session=False)
+            session.query(EnrichmentBackfill).filter(
+                EnrichmentBackfill.cl_id.in_(cl_ids)).delete(synchronize_session=False)
+            session.query(Listing).filter(Listing.id.in_(ids)).delete(synchronize_session=False)
+            session.commit()
+        session.expunge_all()
+
+        archived += len(listings)
+
+    return archived
+
+def _listing_to_json(listing):
+    """
+    Converts a listing row to a JSON-serializable dictionary.
+    :param listing: The Listing row.
+    :return: A dictionary of column names to values.
+    """
+    row = {}
+    for column in Listing.__table__.columns:
+        value = getattr(listing, column.name)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        row[column.name] = value
+    return row
+
+def incremental_vacuum(pages):
+    """
+    Returns free pages of the SQLite file to the operating system. Does
+    nothing for other databases, or for an SQLite database not yet switched
+    to incremental auto-vacuum, since switching needs a full VACUUM that
+    would block the scraper; see enable_incremental_vacuum.
+    :param pages: The most pages to free.
+    """
+    engine = get_engine()
+    if engine.dialect.name != "sqlite":
+        return
+
+    with db_lock:
+        with engine.connect() as connection:
+            connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+            # 2 means incremental auto-vacuum
+            if connection.execute(text("PRAGMA auto_vacuum")).scalar() != 2:
+                print("Warning: The database is not using incremental auto-vacuum. "
+                      "Run python retention.py while the scraper is stopped to switch it.")
+                return
+            connection.execute(text("PRAGMA incremental_vacuum({:d})".format(pages)))
+
+def enable_incremental_vacuum():
+    """
+    Switches an SQLite database created without incremental auto-vacuum over
+    to it. This rewrites the whole file with VACUUM, which can take minutes
+    on a large database, so it is run by hand while the scraper is stopped.
+    New databases use incremental auto-vacuum from the start.
+    """
+    engine = get_engine()
+    if engine.dialect.name != "sqlite":
+        print("Only SQLite databases need to be switched to incremental auto-vacuum.")
+        return
+
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        if connection.execute(text("PRAGMA auto_vacuum")).scalar() == 2:
+            print("The database already uses incremental auto-vacuum.")
+            return
+        print("{}: Switching the database to incremental auto-vacuum...".format(time.ctime()))
+        connection.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+        connection.execute(text("VACUUM"))
+        print("{}: Done".format(time.ctime()))
+
+def run_retention():
+    """
+    Runs one pass of the retention job: archives old listings, purges the
+    expired cache entries and vacuums the database.
+    """
+    try:
+        archived = archive_old_listings(settings.RETENTION_MAX_AGE,
+                                        settings.RETENTION_ARCHIVE_DIR,
+                                        settings.RETENTION_BATCH_SIZE)
+
+        # Close our read transaction, which would keep the vacuum from running
+        session.remove()
+        purged = (location_helper.geocode_cache.disk.purge_expired() +
+                  location_helper.commute_cache.disk.purge_expired())
+        incremental_vacuum(settings.RETENTION_VACUUM_PAGES)
+        print("{}: Archived {} listings and purged {} cache entries".format(
+            time.ctime(), archived, purged))
+    finally:
+        session.remove()
+
+def start_retention_worker():
+    """
+    Starts a background thread running the retention job on a schedule, so
+    it never blocks the scrape loop.
+    :return: The started thread.
+    """
+    def run():
+        while True:
+            try:
+                run_retention()
+            except Exception as exc:
+                print("Error with the retention job:", exc)
+                traceback.print_exc()
+            time.sleep(settings.RETENTION_INTERVAL)
+
+    thread = threading.Thread(target=run, name="retention", daemon=True)
+    thread.start()
+    return thread
+
+if "__main__" == __name__:
+    enable_incremental_vacuum()
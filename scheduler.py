@@ -0,0 +1,105 @@
+import random
+import time
+
+
+class AreaScheduler:
+    """
+    Plans when each area is scraped next. An area is polled about as often as
+    it takes for a target number of new listings to arrive, within fixed
+    bounds, and backs off exponentially after errors.
+    """
+    def __init__(self, areas, initial_interval, min_interval, max_interval,
+                 target_new_listings, jitter, max_backoff):
+        """
+        Initializes an instance of this class. Every area is due right away.
+        :param areas: A list of areas to schedule.
+        :param initial_interval: The interval in seconds used until the
+        arrival rate of an area is known.
+        :param min_interval: The shortest interval in seconds between polls.
+        :param max_interval: The longest interval in seconds between polls.
+        :param target_new_listings: The number of new listings we expect to
+        find on each poll.
+        :param jitter: The fraction by which each interval is randomly
+        stretched or shrunk.
+        :param max_backoff: The longest interval in seconds after errors.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_new_listings = target_new_listings
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+
+        now = time.time()
+        self.areas = {}
+        for area in areas:
+            self.areas[area] = {
+                "next_run": now,
+                "interval": initial_interval,
+                "arrival_rate": None,
+                "errors": 0
+            }
+
+    def due_areas(self, now=None):
+        """
+        Finds the areas due for a scrape.
+        :param now: The current epoch time. Defaults to the current time.
+        :return: A list of areas.
+        """
+        now = time.time() if now is None else now
+        return [area for area, state in self.areas.items() if state["next_run"] <= now]
+
+    def seconds_until_next_run(self, now=None):
+        """
+        Finds how long to wait until the next area is due.
+        :param now: The current epoch time. Defaults to the current time.
+        :return: The number of seconds to wait, or 0 if an area is already due.
+        """
+        now = time.time() if now is None else now
+        if not self.areas:
+            return self.max_interval
+        return max(0, min(state["next_run"] for state in self.areas.values()) - now)
+
+    def next_run_times(self):
+        """
+        Gets the planned run time of every area.
+        :return: A dictionary of areas to epoch times.
+        """
+        return {area: state["next_run"] for area, state in self.areas.items()}
+
+    def record_success(self, area, arrival_rate):
+        """
+        Plans the next run of an area after a successful scrape.
+        :param area: The scraped area.
+        :param arrival_rate: The number of new listings per second in the area.
+        """
+        state = self.areas[area]
+        state["errors"] = 0
+        state["arrival_rate"] = arrival_rate
+
+        # Poll when about the target number of new listings has arrived
+        if arrival_rate > 0:
+            interval = self.target_new_listings / arrival_rate
+        else:
+            interval = self.max_interval
+        state["interval"] = min(self.max_interval, max(self.min_interval, interval))
+        state["next_run"] = time.time() + self._with_jitter(state["interval"])
+
+    def record_failure(self, area, rate_limited=False):
+        """
+        Backs off an area after a failed scrape.
+        :param area: The area that failed.
+        :param rate_limited: Whether the failure was caused by rate limiting,
+        which backs off twice as fast.
+        """
+        state = self.areas[area]
+        state["errors"] += 2 if rate_limited else 1
+        interval = min(self.max_backoff, self.min_interval * 2 ** state["errors"])
+        state["next_run"] = time.time() + self._with_jitter(interval)
+
+    def _with_jitter(self, interval):
+        """
+        Randomly stretches or shrinks an interval so areas don't line up.
+        :param interval: The interval in seconds.
+        :return: The interval with jitter applied.
+        """
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
@@ -1,43 +1,112 @@
+import os
+import socket
 import time
-from craigslist import CraigslistHousing
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean
-from sqlalchemy.orm import sessionmaker
-from dateutil.parser import parse
+import datetime
+import threading
+import traceback
+from sqlalchemy import func
 import location_helper
-from slackclient import SlackClient
+import metrics
+from slack_queue import SlackQueue
+from pipeline import Pipeline
+from listing_record import ListingRecord
+from storage import Listing, ListingSignature, AreaState, SeenListing, EnrichmentBackfill
+from storage import session, db_lock, insert_ignoring_duplicates
+from backfill import backfill_rows, claim_backfill, pending_backfill_count
+from backfill import BACKFILL_GEOCODE, BACKFILL_COMMUTE
+from job_queue import job_key
+from near_duplicate import NearDuplicateDetector, signature_rows
+from commute_estimator import load_commute_estimator
 import settings
-from condition import Condition, LocationCondition
+from condition import Condition, LocationCondition, CommuteCondition
+from condition import COST_LOCAL, COST_GEO, COST_COMMUTE
 
-# Database connection
-DBEngine = create_engine('sqlite:///listings.db', echo=False)
-Base = declarative_base()
-
-class Listing(Base):
+def find_existing_cl_ids(cl_ids):
     """
-    A table to store data on craigslist listings.
+    Finds which Craigslist ids are already stored in the database, including
+    the listings archived by the retention job.
+    :param cl_ids: A list of Craigslist ids.
+    :return: The set of ids already stored, as integers.
     """
+    if not cl_ids:
+        return set()
+
+    cl_ids = [int(cl_id) for cl_id in cl_ids]
+    rows = session.query(Listing.cl_id).filter(Listing.cl_id.in_(cl_ids)).union(
+        session.query(SeenListing.cl_id).filter(SeenListing.cl_id.in_(cl_ids))).all()
+    return set(row[0] for row in rows)
 
-    __tablename__ = 'listings'
+def get_arrival_rates(areas, window):
+    """
+    Calculates how fast new listings arrive in each area, from the creation
+    time of the listings stored in the database.
+    :param areas: A list of areas.
+    :param window: The number of seconds of history to look at.
+    :return: A dictionary of areas to new listings per second.
+    """
+    since = datetime.datetime.now() - datetime.timedelta(seconds=window)
+    rows = session.query(Listing.area, func.count(Listing.id)).filter(
+        Listing.area.in_(areas), Listing.created >= since).group_by(Listing.area).all()
 
-    id = Column(Integer, primary_key=True)
-    link = Column(String, unique=True)
-    created = Column(DateTime)
-    geotag = Column(String)
-    lat = Column(Float)
-    lon = Column(Float)
-    name = Column(String)
-    price = Column(Float)
-    location = Column(String)
-    cl_id = Column(Integer, unique=True)
-    area = Column(String)
-    commute_time = Column(Float)
+    rates = dict((area, 0.0) for area in areas)
+    for area, count in rows:
+        rates[area] = count / window
+    return rates
 
-Base.metadata.create_all(DBEngine)
+def is_rate_limited(exc):
+    """
+    Checks if an exception was caused by Craigslist rate limiting us.
+    :param exc: The exception raised while scraping.
+    :return: True if the response status was 403 or 429; otherwise false.
+    """
+    response = getattr(exc, "response", None)
+    return response is not None and response.status_code in (403, 429)
 
-Session = sessionmaker(bind=DBEngine)
-session = Session()
+class SiteThrottle:
+    """
+    Limits how many requests run against one Craigslist site at a time, and
+    keeps a politeness delay between the start of consecutive requests.
+    """
+    def __init__(self, concurrency, delay):
+        """
+        Initializes an instance of this class.
+        :param concurrency: The maximum number of concurrent requests.
+        :param delay: The minimum number of seconds between requests.
+        """
+        self.delay = delay
+        self._semaphore = threading.Semaphore(concurrency)
+        self._lock = threading.Lock()
+        self._next_request_time = 0
+
+    def __enter__(self):
+        self._semaphore.acquire()
+
+        # Reserve the next slot, then wait for it outside the lock
+        with self._lock:
+            now = time.time()
+            wait = max(0, self._next_request_time - now)
+            self._next_request_time = now + wait + self.delay
+        time.sleep(wait)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._semaphore.release()
+
+# Throttles are shared by every scraper hitting the same site
+site_throttles = {}
+site_throttles_lock = threading.Lock()
+
+def get_site_throttle(site):
+    """
+    Gets the throttle of a Craigslist site, creating it if needed.
+    :param site: The Craigslist site.
+    :return: The SiteThrottle of the site.
+    """
+    with site_throttles_lock:
+        if site not in site_throttles:
+            site_throttles[site] = SiteThrottle(settings.SCRAPE_SITE_CONCURRENCY,
+                                                settings.SCRAPE_POLITENESS_DELAY)
+        return site_throttles[site]
 
 class Scraper:
     """
@@ -45,30 +114,74 @@ class Scraper:
     criteria.
     """
     def __init__(self, site, category, areas_filters_dict,
-                 slack_settings):
+                 slack_settings, deliver_slack=True):
         """
         Initializes and instance of this class.
         :param site: The Craigslist site to search.
         :param category: The category of the housing search.
         :param areas_filters_dict: A dictionary of areas with filters to search.
+        :param deliver_slack: Whether this scraper drains the Slack queue. Only
+        one queue may drain the outbox, so no message is posted twice; the
+        main loop starts its own and passes False.
         """
         # Create Craigslist clients for each area
+        self.site = site
+        self.category = category
         self.cl_clients = {}
         for area, filters in areas_filters_dict.items():
-            self.cl_clients[area] = CraigslistHousing(site=site,
-                                                      category=category,
-                                                      area=area,
-                                                      filters=filters)
+            self.add_area(area, filters)
 
         # Create a Slack client to post satisfying listings to
+        from slackclient import SlackClient
         self.slack_client = SlackClient(slack_settings["slack_token"])
         self.slack_channel = slack_settings["slack_channel"]
 
+        # Deliver Slack messages from a background queue so posting never
+        # blocks scraping
+        self.slack_queue = SlackQueue(self.slack_client,
+                                      settings.SLACK_QUEUE_DB_PATH,
+                                      settings.SLACK_QUEUE_BATCH_SIZE,
+                                      settings.SLACK_CHANNEL_INTERVAL,
+                                      settings.SLACK_QUEUE_POLL_INTERVAL,
+                                      settings.SLACK_MAX_ATTEMPTS)
+        if deliver_slack:
+            self.slack_queue.start()
+
         # Initialize filtering conditions
         self.conditions = []
 
-        # Initialize work geocode
-        self.work_geocode = location_helper.get_geocode(settings.WORK_ADDRESS)
+        # Where the metrics are written after each scrape
+        self.metrics_file = settings.METRICS_FILE
+
+        # The work geocode is looked up on first use
+        self._work_geocode = None
+
+        # Estimates commute times from earlier listings, refitted every scrape
+        self.commute_estimator = None
+
+    def add_area(self, area, filters):
+        """
+        Adds an area to search, or replaces the filters of an area.
+        :param area: The area to search.
+        :param filters: A dictionary of filters of the area.
+        """
+        from craigslist import CraigslistHousing
+        self.cl_clients[area] = CraigslistHousing(site=self.site,
+                                                  category=self.category,
+                                                  area=area,
+                                                  filters=filters)
+
+    @property
+    def work_geocode(self):
+        """
+        Gets the geocode of the work address, looking it up on first use. The
+        geocode cache keeps it on disk, so later processes don't call the API.
+        :return: A tuple of (lat, lon), or None if the lookup failed. It is
+        tried again on the next use.
+        """
+        if self._work_geocode is None:
+            self._work_geocode = location_helper.get_geocode(settings.WORK_ADDRESS)
+        return self._work_geocode
 
     def add_condition(self, condition):
         """
@@ -79,182 +192,553 @@ class Scraper:
             print("Condition is not well defined.")
             return
 
-        # Add the condition
+        # Add the condition, keeping the cheapest conditions first
         self.conditions.append(condition)
+        self.conditions.sort(key=lambda condition: condition.cost)
 
-    def scrape(self):
+    def scrape(self, areas=None):
         """
-        Runs the Craigslist scraper, and posts data to slack.
+        Runs the Craigslist scraper, and posts data to slack. Listings stream
+        through the stages as soon as they are fetched:
+        fetch -> dedupe -> geocode -> commute -> persist -> notify.
+        Each stage filters out the listings failing the conditions of its
+        cost tier before the next, more expensive stage.
+        :param areas: A list of areas to scrape. Defaults to all the areas.
+        :return: A dictionary of the areas that failed to the exception raised.
+        """
+        if areas is None:
+            areas = list(self.cl_clients)
+
+        failures = {}
+        area_states = {}
+        seen_ids = set()
+        detector = NearDuplicateDetector()
+        self.commute_estimator = None
+        if self.commute_threshold() is not None and self.work_geocode is not None:
+            self.commute_estimator = load_commute_estimator(self.work_geocode)
+
+        pipeline = Pipeline(settings.PIPELINE_BUFFER_SIZE, teardown=session.remove)
+        pipeline.add_stage("dedupe",
+                           lambda listings: self._dedupe_stage(listings, seen_ids, detector),
+                           batch_size=settings.PIPELINE_BATCH_SIZE)
+        pipeline.add_stage("geocode", self._geocode_stage)
+        pipeline.add_stage("commute", self._commute_stage,
+                           batch_size=location_helper.GMAPS_MATRIX_MAX_ORIGINS,
+                           linger=settings.PIPELINE_COMMUTE_LINGER)
+        pipeline.add_stage("persist", self._persist_stage,
+                           batch_size=settings.PIPELINE_BATCH_SIZE)
+        pipeline.add_stage("notify", self._notify_stage)
+
+        # Fetch the areas concurrently into the pipeline
+        with metrics.timer("scrape_cycle_seconds"):
+            sources = [self._fetch_stage(area, failures, area_states) for area in areas]
+            result_count = pipeline.run(sources, workers=settings.SCRAPE_WORKERS)
+
+            # Move the high-water marks forward once every listing is saved
+            with db_lock, metrics.timer("db_commit_seconds", table="area_states"):
+                for area, area_state in area_states.items():
+                    if area not in failures:
+                        session.merge(area_state)
+                session.commit()
+        metrics.increment("scrape_cycles_total")
+        metrics.increment("scrape_area_failures_total", len(failures))
+
+        # Resolve the lookups deferred by this and earlier cycles
+        try:
+            deadline = time.time() + settings.BACKFILL_TIME_LIMIT
+            while self.run_backfill() and time.time() < deadline:
+                pass
+        except Exception as exc:
+            print("Error with the backfill:", exc)
+            traceback.print_exc()
+        finally:
+            session.remove()
+
+        print("{}: Got {} results".format(time.ctime(), result_count))
+        print("{}: Geocode cache {} (hit rate {:.0%})".format(
+            time.ctime(),
+            location_helper.geocode_cache.stats,
+            location_helper.geocode_cache.hit_rate()))
+        print("{}: Commute cache {} (hit rate {:.0%})".format(
+            time.ctime(),
+            location_helper.commute_cache.stats,
+            location_helper.commute_cache.hit_rate()))
+        self.report_budget()
+
+        # Leave a snapshot of the metrics for dashboards and benchmarks
+        if self.metrics_file:
+            try:
+                metrics.registry.dump(self.metrics_file)
+            except OSError as exc:
+                print("Warning: Failed to write the metrics file: {}".format(exc))
+
+        return failures
+
+    def _fetch_stage(self, area, failures, area_states):
         """
+        Yields the new listings of an area as they are fetched. A failing area
+        doesn't stop the other areas.
+        :param area: The area to fetch.
+        :param failures: A dictionary collecting the areas that failed.
+        :param area_states: A dictionary collecting the new high-water mark
+        of each area.
+        :return: A generator of listings.
+        """
+        try:
+            for listing in self.iter_new_listings(area):
+                # The newest listing fetched is the new high-water mark
+                if area not in area_states:
+                    area_states[area] = AreaState(key=self._area_key(area),
+                                                  last_cl_id=listing.cl_id,
+                                                  last_created=listing.created)
+                yield listing
+        except Exception as exc:
+            print("Error with scraping area {}:".format(area), exc)
+            traceback.print_exc()
+            failures[area] = exc
+
+    def _dedupe_stage(self, listings, seen_ids, detector):
+        """
+        Drops the listings already in the database or already seen in this
+        cycle, and links reposts of earlier listings to their original. Then
+        checks the cheap conditions. Reposts are rejected so they cost no API
+        calls and are not posted again.
+        :param listings: A batch of listings.
+        :param seen_ids: The set of ids seen in this cycle.
+        :param detector: The NearDuplicateDetector of this cycle.
+        :return: The new listings.
+        """
+        # Find the listings, and the listings they repost, already in the
+        # database with a single query
+        with metrics.timer("dedupe_query_seconds"):
+            existing_ids = find_existing_cl_ids(
+                [listing.cl_id for listing in listings] +
+                [listing.repost_of for listing in listings if listing.repost_of is not None])
 
-        # Get all the results from craigslist.
-        all_results = []
-        for area in self.cl_clients:
-            all_results += self.scrape_area(area)
+        results = []
+        for listing in listings:
+            # Skip the listing if it is already in the database. The same
+            # listing can also show up in more than one area.
+            if listing.cl_id in existing_ids or listing.cl_id in seen_ids:
+                continue
+            seen_ids.add(listing.cl_id)
+            results.append(listing)
 
-        print("{}: Got {} results".format(time.ctime(), len(all_results)))
+        # Craigslist flags some reposts itself; compare the others' content
+        for listing in results:
+            if listing.repost_of in existing_ids or listing.repost_of in seen_ids:
+                listing.duplicate_of = listing.repost_of
+        with metrics.timer("near_duplicate_seconds"):
+            detector.check([listing for listing in results if listing.duplicate_of is None])
+        metrics.increment("listings_known_total", len(listings) - len(results))
+        metrics.increment("listings_new_total", len(results))
+
+        # Check the cheap conditions before any geocoding
+        for listing in results:
+            if listing.duplicate_of is not None:
+                metrics.increment("listings_duplicate_total")
+                listing.rejected = True
+            else:
+                listing.rejected = not self.passes_conditions(listing, COST_LOCAL)
 
-        # Post each result to slack.
-        for result in all_results:
-            self.post_listing_to_slack(result)
+        return results
 
-    def scrape_area(self, area):
+    def _geocode_stage(self, listings):
         """
-        Scrapes craigslist for a certain geographic area, and finds
-        the latest listings.
-        :param area:
-        :return: A list of results.
+        Takes the location of the listings still in the running from their
+        geotag, then checks the location conditions. Listings without a geotag
+        are deferred to the backfill, which geocodes their locations in batches,
+        so they don't hold up the geotagged listings.
+        :param listings: A batch of listings.
+        :return: The same listings.
         """
-        # Get the latest listing on Craigslist
-        listings = self.cl_clients[area].get_results(sort_by='newest',
-                                                     geotagged=True,
-                                                     limit=20)
-        results = []
+        for listing in listings:
+            if not listing.rejected:
+                if listing.geotag is None:
+                    listing.deferred = BACKFILL_GEOCODE
+                    continue
+                self.update_geographic_information(listing)
+                listing.rejected = not self.passes_conditions(listing, COST_GEO)
+        return listings
 
-        print("Browsing through the new listings...")
+    def _commute_stage(self, listings):
+        """
+        Resolves the commute time of the listings still in the running in one
+        batch, then checks the commute conditions. Listings whose estimated
+        commute time is clearly above or below the maximum are settled
+        without a lookup. While the budget is low, only cached commute times
+        are used and the other listings are deferred.
+        :param listings: A batch of listings.
+        :return: The same listings.
+        """
+        candidates = [listing for listing in listings
+                      if not listing.rejected and listing.deferred is None]
+
+        # Listings that could not be located keep an unknown commute time
+        for listing in candidates:
+            if listing.lat is None:
+                listing.rejected = not self.passes_conditions(listing, COST_COMMUTE)
+        candidates = [listing for listing in candidates if listing.lat is not None]
+        candidates = self.estimate_commute_times(candidates)
+        degraded = location_helper.gmaps_budget.is_low("distancematrix")
+        with metrics.timer("directions_seconds"):
+            self.update_commute_times(candidates, cached_only=degraded)
+        for listing in candidates:
+            if listing.commute_time is None:
+                listing.deferred = BACKFILL_COMMUTE
+            else:
+                listing.rejected = not self.passes_conditions(listing, COST_COMMUTE)
+        return listings
+
+    def commute_threshold(self):
+        """
+        Gets the longest commute time the commute conditions accept.
+        :return: The number of seconds, or None without a commute condition.
+        """
+        max_commute_times = [condition.max_commute_time for condition in self.conditions
+                             if isinstance(condition, CommuteCondition)]
+        return min(max_commute_times) if max_commute_times else None
 
-        # Process new listing and check for criteria
-        for listing in listings:
-            # Skip the listing if it is already in the database
-            existing_listing = session.query(Listing).filter_by(cl_id=listing["id"]).first()
-            if existing_listing is not None:
+    def estimate_commute_times(self, listings):
+        """
+        Estimates the commute times of the listings, and keeps the estimate
+        where its confidence band is entirely above or below the maximum
+        commute time. The listings so settled are checked against the
+        commute conditions right away.
+        :param listings: The listings with their location resolved.
+        :return: The listings whose commute time still needs a lookup.
+        """
+        threshold = self.commute_threshold()
+        if (not listings or threshold is None or self.commute_estimator is None or
+                not self.commute_estimator.is_fitted()):
+            return listings
+
+        estimates, lows, highs = self.commute_estimator.estimate(
+            [listing.lat for listing in listings], [listing.lon for listing in listings])
+
+        remaining = []
+        for listing, estimate, low, high in zip(listings, estimates, lows, highs):
+            if low <= threshold <= high:
+                remaining.append(listing)
                 continue
+            listing.commute_time = float(estimate)
+            listing.commute_estimated = True
+            listing.rejected = not self.passes_conditions(listing, COST_COMMUTE)
+        metrics.increment("commute_estimated_total", len(listings) - len(remaining))
+        return remaining
 
-            # Update location and transportation information
-            listing = self.update_geographic_information(listing)
-
-            # Create and save the listing so we don't grab it again.
-            listing_entity = self._create_listing_entity(listing)
-            session.add(listing_entity)
+    def _persist_stage(self, listings):
+        """
+        Saves every listing, rejected or not, so we don't grab them again.
+        The rows are inserted in bulk without building ORM objects. Listings
+        another worker saved first are skipped.
+        :param listings: A batch of listings.
+        :return: The same listings.
+        """
+        rows = [listing.to_row() for listing in listings]
+        if not rows:
+            return listings
+
+        signatures = signature_rows(listings)
+        deferred = backfill_rows(listings)
+        with db_lock, metrics.timer("db_commit_seconds", table="listings"):
+            session.execute(insert_ignoring_duplicates(Listing.__table__), rows)
+            if signatures:
+                session.execute(ListingSignature.__table__.insert(), signatures)
+            if deferred:
+                session.execute(insert_ignoring_duplicates(EnrichmentBackfill.__table__), deferred)
             session.commit()
+        return listings
 
-            # Check the listing against conditions
-            is_good_listing = True
-            for condition in self.conditions:
-                # Continue if the listing satisfies the current condition
-                if condition.check(listing):
-                    continue
+    def _notify_stage(self, listings):
+        """
+        Queues the listings satisfying all the conditions to be posted to slack.
+        Deferred listings are posted by the backfill once they are checked.
+        :param listings: A batch of listings.
+        :return: The posted listings.
+        """
+        results = [listing for listing in listings
+                   if not listing.rejected and listing.deferred is None]
+        for listing in results:
+            self.post_listing_to_slack(listing)
+        metrics.increment("listings_accepted_total", len(results))
+        return results
 
-                # Otherwise, mark the listing as bad
-                is_good_listing = False
+    def iter_new_listings(self, area):
+        """
+        Fetches the listings of an area posted since its high-water mark,
+        newest first. Pages are fetched until the mark is reached, up to a
+        safety cap. Without a mark, only the latest few listings are fetched.
+        :param area: The area to fetch.
+        :return: A generator of ListingRecords.
+        """
+        area_state = session.query(AreaState).filter_by(key=self._area_key(area)).first()
+        limit = settings.SCRAPE_INITIAL_RESULTS if area_state is None else None
+
+        count = 0
+        throttle = get_site_throttle(self.site)
+        results = iter(self.cl_clients[area].get_results(sort_by='newest',
+                                                         geotagged=True,
+                                                         limit=limit))
+        while True:
+            # Results are fetched as we iterate: a search page at a time, and
+            # the page of each listing for its geotag. The throttle is only
+            # held while fetching, not while the pipeline is busy.
+            with throttle:
+                with metrics.timer("craigslist_fetch_seconds", area=area):
+                    result = next(results, None)
+            if result is None:
                 break
+            metrics.increment("listings_fetched_total", area=area)
 
-            # Do nothing if it is a bad listing
-            if not is_good_listing:
-                continue
+            listing = ListingRecord.from_result(result, area)
 
-            # Add the listing to return listings and database
-            results.append(listing)
+            # Stop once we reach the newest listing seen last time
+            if area_state is not None and (
+                    listing.cl_id == area_state.last_cl_id or
+                    listing.created < area_state.last_created):
+                break
 
-        # Return all the good results
-        return results
+            yield listing
+            count += 1
+            if count >= settings.SCRAPE_MAX_RESULTS:
+                print("Warning: Reached the cap of {} listings in area {}.".format(
+                    settings.SCRAPE_MAX_RESULTS, area))
+                break
+
+    def _area_key(self, area):
+        """
+        Builds the key of an area in the area_states table.
+        :param area: The area.
+        :return: The key made of the site, category and area.
+        """
+        return job_key(self.site, self.category, area)
+
+    def passes_conditions(self, listing, cost):
+        """
+        Checks the listing against the filtering conditions of a cost tier.
+        :param listing: The listing to check.
+        :param cost: The cost tier of the conditions to check.
+        :return: True if the listing satisfies every condition of the tier;
+        otherwise false.
+        """
+        for condition in self.conditions:
+            if condition.cost == cost and not condition.check(listing):
+                metrics.increment("listings_rejected_total",
+                                  condition=type(condition).__name__)
+                return False
+        return True
 
     def post_listing_to_slack(self, listing):
         """
-        Posts the result to Slack channel.
-        :param result: The result to post to Slack channel.
+        Queues the result to be posted to Slack channel.
+        :param listing: The ListingRecord to post to Slack channel.
         """
         # Data validation
-        if listing is not None and not listing:
+        if listing is None:
             print("Warning: The listing is not well defined.")
             return
 
-        # Commute time
-        duration = listing['commute_time']
-        minutes = duration // 60
-        seconds = duration % 60
+        # Commute time, rounded to the minute if it is only estimated
+        duration = listing.commute_time
+        if duration is None or duration < 0:
+            commute = "N/A"
+        elif listing.commute_estimated:
+            commute = "~{:.0f}m".format(duration / 60)
+        else:
+            commute = "{:.0f}m{:.0f}s".format(duration // 60, duration % 60)
 
         # Build the description string to post
-        desc = "{} | {} | {} | {}m{}s | <{}>".format(
-            listing["area"],
-            listing["price"],
-            listing["name"],
-            minutes,
-            seconds,
-            listing["url"])
+        desc = "{} | {} | {} | {} | <{}>".format(
+            listing.area,
+            "N/A" if listing.price is None else "${:g}".format(listing.price),
+            listing.name,
+            commute,
+            listing.url)
 
         print("Desc: {}".format(desc))
 
-        # Post to Slack
-        self.slack_client.api_call("chat.postMessage",
-                                   channel=self.slack_channel,
-                                   text=desc,
-                                   username='pybot',
-                                   icon_emoji=':robot_face:')
+        # Queue for Slack, keyed on the listing so it is posted only once
+        self.slack_queue.enqueue(self.slack_channel, desc,
+                                 dedupe_key=str(listing.cl_id))
 
-    def update_geographic_information(self, listing):
+    def update_geographic_information(self, listing, geocodes=None):
         """
-        Updates the geographic information such as location, lattitude,
-        longitude and transportation time.
-        :param listing: The listing from Craigslist.
-        :return: The updated listing result.
+        Updates the geographic information such as location, lattitude and
+        longitude. The latitude and longitude are left as None if none of the
+        locations could be geocoded.
+        :param listing: The ListingRecord to update.
+        :param geocodes: A dictionary of locations to geocodes looked up in
+        advance. Locations missing from it are looked up one at a time.
+        :return: The updated listing.
         """
         # Data validation
-        if listing is not None and not listing:
+        if listing is None:
             print("Warning: The listing is not well defined.")
             return listing
-        
+
         # Try to get the geocode from geotag if present
-        if "geotag" in listing and listing["geotag"] is not None:
-            listing["lat"] = listing["geotag"][0]
-            listing["lon"] = listing["geotag"][1]
+        if listing.geotag is not None:
+            listing.lat = listing.geotag[0]
+            listing.lon = listing.geotag[1]
         else:
             # Try to deduce the geocode from the locations
             locations = []
-            if "where" in listing and listing["where"] is not None:
-                locations = location_helper.parse_locations(listing["where"])
+            if listing.where is not None:
+                locations = location_helper.parse_locations(listing.where)
 
-            # Calculate the average geocode of all the locations
+            # Calculate the average geocode of the locations that were found
             avg_lat = 0
             avg_lon = 0
             count = 0
             for location in locations:
-                lat, lon = location_helper.get_geocode(location)
+                if geocodes is not None and location in geocodes:
+                    geocode = geocodes[location]
+                else:
+                    geocode = location_helper.get_geocode(location)
+                if geocode is None or tuple(geocode) == (0, 0):
+                    continue
+                lat, lon = geocode
                 avg_lat += lat
                 avg_lon += lon
                 count += 1
-            listing["lat"] = avg_lat / count
-            listing["lon"] = avg_lon / count
 
-        # Calculate the travel time
-        src = (listing['lat'], listing['lon'])
-        listing['commute_time'] = location_helper.get_travel_time(src,
-                                                                  self.work_geocode)
+            if count == 0:
+                print("Warning: No location of listing {} was found.".format(listing.cl_id))
+                listing.lat = None
+                listing.lon = None
+            else:
+                listing.lat = avg_lat / count
+                listing.lon = avg_lon / count
 
         # Return the updated listing
         return listing
 
-    def _create_listing_entity(self, listing):
+    def update_commute_times(self, listings, cached_only=False):
         """
-        Creates a listing entity for database from the listing result.
-        :param listing: The listing result from Craigslist.
-        :return: The Listing entity for database.
+        Updates the transportation time of the listings to work. All the
+        listings are resolved together to batch the API requests.
+        :param listings: The listings with their location resolved.
+        :param cached_only: Whether to only use cached commute times. The
+        others are left as None.
         """
-        # Data validation
-        if listing is None:
-            print("Warning: listing parameter should not be None.")
-            return None
+        srcs = [(listing.lat, listing.lon) for listing in listings]
+        durations = location_helper.get_travel_times(srcs, self.work_geocode,
+                                                     cached_only=cached_only)
+        for listing, duration in zip(listings, durations):
+            listing.commute_time = duration
 
-        # Try parsing the price
-        price = -1
-        try:
-            price = float(listing["price"].replace("$", ""))
-        except OverflowError:
-            pass
-
-        # TODO: Clean up the area and bart station
-        listing["area"] = "Seattle"
-
-        # Create listing entity
-        return Listing(
-            link=listing["url"],
-            created=parse(listing["datetime"]),
-            lat=listing["lat"],
-            lon=listing["lon"],
-            name=listing["name"],
-            price=price,
-            location=listing["where"],
-            cl_id=listing["id"],
-            area=listing["area"],
-            commute_time=listing["commute_time"]
-        )
+    def run_backfill(self):
+        """
+        Resolves a batch of the deferred lookups, for the endpoints whose
+        budget is not low. Each distinct location of the batch is geocoded
+        once. The listings are updated in place, checked against the
+        remaining conditions, and posted to Slack if they pass. Lookups that
+        fail are queued again, until they have been tried
+        BACKFILL_MAX_ATTEMPTS times.
+        :return: The number of lookups claimed.
+        """
+        kinds = []
+        if not location_helper.gmaps_budget.is_low("geocode"):
+            kinds.append(BACKFILL_GEOCODE)
+        if not location_helper.gmaps_budget.is_low("distancematrix"):
+            kinds.append(BACKFILL_COMMUTE)
+
+        owner = "{}-{}".format(socket.gethostname(), os.getpid())
+        claimed = claim_backfill(kinds, owner, settings.BACKFILL_BATCH_SIZE,
+                                 settings.JOB_LEASE_DURATION)
+        if not claimed:
+            return 0
+
+        rows = session.query(Listing).filter(
+            Listing.cl_id.in_([cl_id for _, cl_id, _, _ in claimed])).all()
+        records = dict((row.cl_id, ListingRecord.from_row(row)) for row in rows)
+        attempts = dict(((cl_id, kind), count + 1) for _, cl_id, kind, count in claimed)
+
+        # Locate the listings first, then look up their commute times together
+        unlocated = [records[cl_id] for _, cl_id, kind, _ in claimed
+                     if kind == BACKFILL_GEOCODE and cl_id in records]
+        locations = set()
+        for listing in unlocated:
+            if listing.where is not None:
+                locations.update(location_helper.parse_locations(listing.where))
+        with metrics.timer("geocode_seconds"):
+            geocodes = location_helper.get_geocodes(locations)
+        for listing in unlocated:
+            # Try again later if a location failed, rather than settle for the rest
+            failed = listing.where is not None and any(
+                geocodes.get(location) is None
+                for location in location_helper.parse_locations(listing.where))
+            if failed and self._retry_backfill(listing, BACKFILL_GEOCODE, attempts):
+                continue
+            self.update_geographic_information(listing, geocodes)
+            listing.rejected = not self.passes_conditions(listing, COST_GEO)
+
+        listings = [listing for listing in records.values()
+                    if not listing.rejected and listing.deferred is None]
+        listings = self._commute_stage(listings)
+
+        # Give up on the commute times that failed too often; they stay unknown
+        for listing in listings:
+            if listing.deferred == BACKFILL_COMMUTE:
+                listing.deferred = None
+                if self._retry_backfill(listing, BACKFILL_COMMUTE, attempts):
+                    continue
+                listing.rejected = not self.passes_conditions(listing, COST_COMMUTE)
+        listings = list(records.values())
+
+        with db_lock:
+            for listing in records.values():
+                session.query(Listing).filter_by(cl_id=listing.cl_id).update(
+                    {"lat": listing.lat, "lon": listing.lon,
+                     "commute_time": listing.commute_time,
+                     "commute_estimated": listing.commute_estimated},
+                    synchronize_session=False)
+            session.query(EnrichmentBackfill).filter(
+                EnrichmentBackfill.id.in_([backfill_id for backfill_id, _, _, _ in claimed])).delete(
+                synchronize_session=False)
+            deferred = backfill_rows(listings, attempts)
+            if deferred:
+                session.execute(insert_ignoring_duplicates(EnrichmentBackfill.__table__), deferred)
+            session.commit()
+
+        self._notify_stage(listings)
+        metrics.increment("backfill_resolved_total", len(claimed))
+        return len(claimed)
+
+    def _retry_backfill(self, listing, kind, attempts):
+        """
+        Defers a failed lookup of the backfill again, unless it was tried too
+        many times.
+        :param listing: The ListingRecord whose lookup failed.
+        :param kind: The kind of the lookup.
+        :param attempts: A dictionary of (cl_id, kind) to the number of times
+        the lookup was tried, including this one.
+        :return: True if the lookup is deferred again; otherwise false.
+        """
+        count = attempts.get((listing.cl_id, kind), 1)
+        if count >= settings.BACKFILL_MAX_ATTEMPTS:
+            print("Warning: Giving up the {} lookup of listing {} after {} attempts.".format(
+                kind, listing.cl_id, count))
+            metrics.increment("backfill_abandoned_total", kind=kind)
+            return False
+
+        listing.deferred = kind
+        attempts[(listing.cl_id, kind)] = count
+        return True
+
+    def report_budget(self):
+        """
+        Prints the remaining Google Maps budget and the deferred lookups.
+        """
+        remaining = location_helper.gmaps_budget.remaining()
+        for endpoint, calls in sorted(remaining.items()):
+            metrics.set_gauge("gmaps_budget_remaining", calls, endpoint=endpoint)
+
+        pending = pending_backfill_count()
+        for kind in (BACKFILL_GEOCODE, BACKFILL_COMMUTE):
+            metrics.set_gauge("backfill_pending", pending.get(kind, 0), kind=kind)
+        session.remove()
+
+        print("{}: Google Maps budget left today {}, deferred lookups {}".format(
+            time.ctime(), remaining, pending))
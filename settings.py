@@ -8,6 +8,11 @@ MIN_PRICE = 1500
 # The maximum rent you want to pay per month.
 MAX_PRICE = 2000
 
+## Commute
+
+# The longest commute to WORK_ADDRESS you want, in seconds, or None for no limit.
+MAX_COMMUTE_TIME = 45 * 60 # 45 minutes
+
 ## Location preferences
 
 # The Craigslist site you want to search on.
@@ -103,16 +108,250 @@ TRANSIT_DEPARTURE_TIME = 1483975800
 # You only need the last 3 letters of the URLs.
 CRAIGSLIST_HOUSING_SECTION = 'apa'
 
+# The searches the bot runs, each a Craigslist site and housing section with
+# the filters of each of its areas. Every (site, category, area) is scraped
+# as its own job.
+SEARCHES = [
+    {
+        "site": "seattle",
+        "category": "roo",
+        "areas": {
+            "see": {"max_price": 800, "min_price": 400}
+        }
+    }
+]
+
 ## System settings
 
 # How long we should sleep between scrapes of Craigslist.
 # Too fast may get rate limited.
 # Too slow may miss listings.
+# This is the interval of an area until its arrival rate of new listings is known.
 SLEEP_INTERVAL = 20 * 60 # 20 minutes
 
+# The bounds of the interval between scrapes of the same area.
+SCHEDULER_MIN_INTERVAL = 5 * 60 # 5 minutes
+SCHEDULER_MAX_INTERVAL = 2 * 60 * 60 # 2 hours
+
+# An area is scraped again once about this many new listings are expected.
+SCHEDULER_TARGET_NEW_LISTINGS = 10
+
+# The fraction by which each interval is randomly stretched or shrunk.
+SCHEDULER_JITTER = 0.1
+
+# The longest interval between scrapes of an area that keeps failing.
+SCHEDULER_MAX_BACKOFF = 6 * 60 * 60 # 6 hours
+
+# How much history is used to calculate the arrival rate of new listings.
+SCHEDULER_ARRIVAL_WINDOW = 24 * 60 * 60 # 1 day
+
+# Where the queue of scrape jobs is kept. Workers on other hosts must point at
+# the same file on shared storage.
+JOB_QUEUE_DB_PATH = 'listings.db'
+
+# How many worker processes the coordinator runs.
+WORKER_PROCESSES = 4
+
+# How long a worker holds a job before another worker may take it over.
+# Leases are renewed while the scrape runs.
+JOB_LEASE_DURATION = 10 * 60 # 10 minutes
+
+# The longest a worker sleeps before checking the queue again.
+JOB_POLL_INTERVAL = 30
+
+# How many areas are scraped concurrently.
+SCRAPE_WORKERS = 4
+
+# How many requests may run against the same Craigslist site at once.
+SCRAPE_SITE_CONCURRENCY = 2
+
+# The minimum number of seconds between requests to the same Craigslist site.
+SCRAPE_POLITENESS_DELAY = 1
+
+# The number of seconds to wait for Google Maps to accept a connection.
+GMAPS_CONNECT_TIMEOUT = 5
+
+# The number of seconds to wait for Google Maps to send a response.
+GMAPS_READ_TIMEOUT = 15
+
+# How many times a failed Google Maps request is retried.
+GMAPS_MAX_RETRIES = 3
+
+# The delay before the first retry, doubled after every attempt.
+GMAPS_BACKOFF_BASE = 1 # seconds
+
+# The maximum number of Google Maps requests per second.
+GMAPS_MAX_QPS = 10
+
+# The number of keep-alive connections kept open to Google Maps.
+GMAPS_POOL_SIZE = 10
+
+# The most listings waiting between two stages of the scraping pipeline.
+# A slow stage makes the stages before it wait once its buffer is full.
+PIPELINE_BUFFER_SIZE = 100
+
+# The most listings a pipeline stage handles at once, such as in one
+# database query or commit.
+PIPELINE_BATCH_SIZE = 50
+
+# The most seconds the commute stage waits for listings to fill a Distance
+# Matrix request, since listings are fetched one at a time. Listings are
+# posted up to this much later in exchange for far fewer requests.
+PIPELINE_COMMUTE_LINGER = 5
+
+# How many of the newest listings are fetched from an area scraped for the first time.
+SCRAPE_INITIAL_RESULTS = 20
+
+# The most listings fetched from one area in a single scrape.
+SCRAPE_MAX_RESULTS = 500
+
+# The database storing the listings. Any SQLAlchemy URL works; a postgresql://
+# URL also needs a driver such as psycopg2 to be installed.
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///listings.db')
+
+# Pragmas applied to every SQLite connection. WAL lets readers run while the
+# scraper writes. Incremental auto-vacuum only takes effect on a new database;
+# run python retention.py once to switch an existing one.
+SQLITE_PRAGMAS = {
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000, # milliseconds
+    'cache_size': -20000, # 20MB
+    'temp_store': 'MEMORY'
+}
+
+# The number of hash functions in the MinHash signature of a listing, used to
+# spot reposts of the same unit under a new id.
+MINHASH_PERMUTATIONS = 64
+
+# The number of LSH bands the signature is split into. More bands find more
+# candidate reposts. Must divide MINHASH_PERMUTATIONS.
+MINHASH_BANDS = 16
+
+# The estimated similarity above which a listing is treated as a repost.
+# Titles must also hold the same numbers, such as the bedrooms or square
+# feet, since units of one building otherwise look alike.
+MINHASH_THRESHOLD = 0.8
+
+# The geohash precision of coordinates compared between listings.
+# Precision 6 is a cell of roughly 1.2km x 0.6km.
+MINHASH_GEOHASH_PRECISION = 6
+
+# The fraction by which the price of a repost may differ from the original.
+MINHASH_PRICE_TOLERANCE = 0.05
+
+# Listings older than this are moved out of the database into the archive.
+RETENTION_MAX_AGE = 90 * 24 * 60 * 60 # 90 days
+
+# The directory of the archive, holding one gzip JSONL file per month.
+RETENTION_ARCHIVE_DIR = 'archive'
+
+# How often the retention job runs.
+RETENTION_INTERVAL = 24 * 60 * 60 # 1 day
+
+# The number of listings archived per transaction.
+RETENTION_BATCH_SIZE = 1000
+
+# The most free database pages returned to the disk on each run.
+RETENTION_VACUUM_PAGES = 1000
+
+# Where the geocode and commute caches are persisted. Defaults to the listings database.
+CACHE_DB_PATH = 'listings.db'
+
+# The maximum number of entries each cache keeps in memory.
+CACHE_MEMORY_SIZE = 1024
+
+# How long a geocode result is reused before asking Google Maps again.
+GEOCODE_CACHE_TTL = 30 * 24 * 60 * 60 # 30 days
+
+# How long an address that returned no results is remembered.
+GEOCODE_NEGATIVE_CACHE_TTL = 24 * 60 * 60 # 1 day
+
+# How long a travel time is reused before asking Google Maps again.
+COMMUTE_CACHE_TTL = 30 * 24 * 60 * 60 # 30 days
+
+# How long an origin without any route is remembered.
+COMMUTE_NEGATIVE_CACHE_TTL = 24 * 60 * 60 # 1 day
+
+# The geohash precision used to snap origins for the commute cache.
+# Precision 7 is a cell of roughly 150m x 150m.
+COMMUTE_CACHE_PRECISION = 7
+
+# The fewest looked up commute times needed before commute times are estimated.
+COMMUTE_ESTIMATOR_MIN_SAMPLES = 50
+
+# The most recent looked up commute times the estimator learns from.
+COMMUTE_ESTIMATOR_MAX_SAMPLES = 5000
+
+# How many nearby listings an estimate is averaged from, how many of them
+# must be within the radius, and the radius in kilometers.
+COMMUTE_ESTIMATOR_NEIGHBORS = 8
+COMMUTE_ESTIMATOR_MIN_NEIGHBORS = 3
+COMMUTE_ESTIMATOR_RADIUS = 1
+
+# The half width of the confidence band in standard deviations, and its
+# narrowest half width in seconds. The commute time is only looked up when
+# the maximum commute time falls inside the band.
+COMMUTE_ESTIMATOR_CONFIDENCE = 2
+COMMUTE_ESTIMATOR_MIN_BAND = 5 * 60 # 5 minutes
+
+# Where a JSON snapshot of the metrics is written after each scrape cycle. None to disable.
+METRICS_FILE = 'metrics.json'
+
+# The port serving the metrics over HTTP, at /metrics for Prometheus and
+# /metrics.json. None to disable.
+METRICS_PORT = None
+
+# Where the budget of Google Maps calls is kept. Every worker process must
+# point at the same file to share the budget.
+API_BUDGET_DB_PATH = 'listings.db'
+
+# The most Google Maps calls per day and per minute for each endpoint.
+# Distance Matrix calls count one per origin. None for no limit.
+GMAPS_BUDGETS = {
+    "geocode": {"per_day": 2500, "per_minute": 100},
+    "directions": {"per_day": 2500, "per_minute": 100},
+    "distancematrix": {"per_day": 2500, "per_minute": 1000}
+}
+
+# Once less than this fraction of an endpoint's daily budget is left, new
+# listings only use cached results and their lookups are queued for later.
+GMAPS_BUDGET_RESERVE = 0.1
+
+# The longest a call waits for the per-minute budget before giving up.
+GMAPS_BUDGET_MAX_WAIT = 10 # seconds
+
+# The most deferred lookups resolved together in one batch.
+BACKFILL_BATCH_SIZE = 100
+
+# How many times a failed deferred lookup is tried before it is given up.
+# The listing is then checked and posted with what is known.
+BACKFILL_MAX_ATTEMPTS = 5
+
+# The most seconds a scrape spends on deferred lookups before it moves on.
+# The rest are resumed by the next scrape.
+BACKFILL_TIME_LIMIT = 60
+
 # Which slack channel to post the listings into.
 SLACK_CHANNEL = "#housing"
 
+# Where the queue of Slack messages waiting to be posted is persisted.
+SLACK_QUEUE_DB_PATH = 'listings.db'
+
+# The most queued listings coalesced into one Slack message.
+SLACK_QUEUE_BATCH_SIZE = 5
+
+# The minimum number of seconds between messages to the same channel.
+# Slack allows about one message per second per channel.
+SLACK_CHANNEL_INTERVAL = 1
+
+# How long the Slack queue waits when there is nothing to send.
+SLACK_QUEUE_POLL_INTERVAL = 5
+
+# How many times a Slack message is retried before it is dropped.
+SLACK_MAX_ATTEMPTS = 5
+
 # The token that allows us to connect to slack.
 # Should be put in private.py, or set as an environment variable.
 SLACK_TOKEN = os.getenv('SLACK_TOKEN', "")
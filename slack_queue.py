@@ -0,0 +1,222 @@
+import json
+import sqlite3
+import threading
+import time
+import metrics
+
+
+class SlackQueue:
+    """
+    An outbound queue of Slack messages persisted in SQLite and drained by a
+    background thread. Each channel is rate limited on its own, bursts are
+    coalesced into a single message, and messages survive a restart.
+    """
+    def __init__(self, slack_client, path, batch_size, channel_interval,
+                 poll_interval, max_attempts):
+        """
+        Initializes an instance of this class. The database is only opened
+        on first use.
+        :param slack_client: The SlackClient used to post messages.
+        :param path: The path of the SQLite database file.
+        :param batch_size: The most queued messages coalesced into one post.
+        :param channel_interval: The minimum number of seconds between posts
+        to the same channel.
+        :param poll_interval: The number of seconds the worker waits when
+        there is nothing to send.
+        :param max_attempts: The number of failed posts after which a message
+        is dropped.
+        """
+        self.slack_client = slack_client
+        self.path = path
+        self.batch_size = batch_size
+        self.channel_interval = channel_interval
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._conn = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._next_post_time = {}
+
+    def _connection(self):
+        """
+        Opens the database and creates the table if needed.
+        :return: The SQLite connection.
+        """
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS slack_outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "dedupe_key TEXT UNIQUE, "
+                "channel TEXT NOT NULL, "
+                "text TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "created_at REAL NOT NULL, "
+                "sent_at REAL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_slack_outbox_pending "
+                "ON slack_outbox (sent_at, channel, id)")
+            self._conn.commit()
+        return self._conn
+
+    def enqueue(self, channel, text, dedupe_key=None):
+        """
+        Queues a message. A message whose key was already queued is ignored,
+        so the same listing is never posted twice.
+        :param channel: The Slack channel to post to.
+        :param text: The text of the message.
+        :param dedupe_key: A unique key of the message, such as the listing id.
+        :return: True if the message was queued; otherwise false.
+        """
+        with self._lock:
+            conn = self._connection()
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO slack_outbox (dedupe_key, channel, text, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (dedupe_key, channel, text, time.time()))
+            conn.commit()
+
+        self._wakeup.set()
+        return cursor.rowcount == 1
+
+    def pending_count(self):
+        """
+        Counts the messages still waiting to be posted.
+        :return: The number of pending messages.
+        """
+        with self._lock:
+            return self._connection().execute(
+                "SELECT COUNT(*) FROM slack_outbox WHERE sent_at IS NULL").fetchone()[0]
+
+    def start(self):
+        """
+        Starts the background worker draining the queue.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="slack-queue", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the background worker. Unsent messages stay in the queue.
+        :param timeout: The number of seconds to wait for the worker.
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        """
+        Drains the queue until stopped.
+        """
+        while not self._stopping.is_set():
+            try:
+                wait = self.drain_once()
+            except Exception as exc:
+                print("Warning: Slack queue failed to drain: {}".format(exc))
+                wait = self.poll_interval
+
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+
+    def drain_once(self):
+        """
+        Posts one batch to every channel that is not rate limited.
+        :return: The number of seconds until a channel can be posted to again.
+        """
+        with self._lock:
+            channels = [row[0] for row in self._connection().execute(
+                "SELECT DISTINCT channel FROM slack_outbox WHERE sent_at IS NULL")]
+
+        wait = self.poll_interval
+        for channel in channels:
+            now = time.time()
+            next_post_time = self._next_post_time.get(channel, 0)
+            if next_post_time > now:
+                wait = min(wait, next_post_time - now)
+                continue
+
+            self._post_batch(channel)
+            wait = min(wait, self.channel_interval)
+        return wait
+
+    def _post_batch(self, channel):
+        """
+        Posts the oldest queued messages of a channel as one message.
+        :param channel: The Slack channel to post to.
+        """
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT id, text FROM slack_outbox "
+                "WHERE sent_at IS NULL AND channel = ? ORDER BY id LIMIT ?",
+                (channel, self.batch_size)).fetchall()
+        if not rows:
+            return
+
+        ids = [row[0] for row in rows]
+        texts = [row[1] for row in rows]
+
+        # Coalesce a burst into one message with an attachment per listing
+        if len(texts) == 1:
+            message = {"text": texts[0]}
+        else:
+            message = {
+                "text": "{} new listings".format(len(texts)),
+                "attachments": json.dumps([{"text": text} for text in texts])
+            }
+
+        with metrics.timer("slack_post_seconds"):
+            response = self.slack_client.api_call("chat.postMessage",
+                                                  channel=channel,
+                                                  username='pybot',
+                                                  icon_emoji=':robot_face:',
+                                                  **message)
+        self._next_post_time[channel] = time.time() + self.channel_interval
+        metrics.increment("slack_posts_total",
+                          result="ok" if response.get("ok") else response.get("error", "unknown"))
+
+        if response.get("ok"):
+            metrics.increment("slack_messages_sent_total", len(ids))
+            self._mark_sent(ids)
+            return
+
+        # Honor the Retry-After header when Slack rate limits us
+        if response.get("error") == "ratelimited":
+            retry_after = response.get("headers", {}).get("Retry-After", self.channel_interval)
+            self._next_post_time[channel] = time.time() + float(retry_after)
+            print("Warning: Slack rate limited channel {} for {}s.".format(channel, retry_after))
+            return
+
+        print("Warning: Failed to post to Slack: {}".format(response.get("error")))
+        self._mark_failed(ids)
+
+    def _mark_sent(self, ids):
+        """
+        Marks messages as sent.
+        :param ids: The ids of the messages.
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.executemany("UPDATE slack_outbox SET sent_at = ? WHERE id = ?",
+                             [(time.time(), message_id) for message_id in ids])
+            conn.commit()
+
+    def _mark_failed(self, ids):
+        """
+        Counts a failed attempt for messages, dropping those that failed too
+        many times.
+        :param ids: The ids of the messages.
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.executemany("UPDATE slack_outbox SET attempts = attempts + 1 WHERE id = ?",
+                             [(message_id,) for message_id in ids])
+            conn.execute("DELETE FROM slack_outbox WHERE sent_at IS NULL AND attempts >= ?",
+                         (self.max_attempts,))
+            conn.commit()
@@ -0,0 +1,146 @@
+import math
+
+
+class BoxGridIndex:
+    """
+    A uniform grid over the neighborhood boxes. Each cell remembers which
+    boxes overlap it, so a lookup only checks the boxes of a single cell.
+    """
+    def __init__(self, boxes, cell_size=0.01):
+        """
+        Initializes an instance of this class.
+        :param boxes: A dictionary of box names to two coordinate tuples, the
+        same format as settings.BOXES.
+        :param cell_size: The size of a grid cell in degrees.
+        """
+        self.cell_size = cell_size
+        self.boxes = list(boxes.items())
+        self.cells = {}
+
+        for index, (name, box) in enumerate(self.boxes):
+            # The same bounds as location_helper.in_box
+            lat_min, lat_max = box[0][0], box[1][0]
+            lon_min, lon_max = box[1][1], box[0][1]
+            if lat_min >= lat_max or lon_min >= lon_max:
+                continue
+
+            # Register the box in every cell it overlaps
+            row_min, col_min = self._cell(lat_min, lon_min)
+            row_max, col_max = self._cell(lat_max, lon_max)
+            for row in range(row_min, row_max + 1):
+                for col in range(col_min, col_max + 1):
+                    self.cells.setdefault((row, col), []).append(index)
+
+    def _cell(self, lat, lon):
+        """
+        Finds the grid cell of a coordinate.
+        :param lat: The latitude.
+        :param lon: The longitude.
+        :return: A tuple of (row, column).
+        """
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lon / self.cell_size)))
+
+    def find(self, coords):
+        """
+        Finds the box containing a coordinate. When boxes overlap, the last
+        one in definition order wins, like a linear scan.
+        :param coords: Tuple containing latitude and longitude.
+        :return: The name of the box, or None if no box contains the coordinate.
+        """
+        found = None
+        for index in self.cells.get(self._cell(coords[0], coords[1]), []):
+            name, box = self.boxes[index]
+            if box[0][0] < coords[0] < box[1][0] and box[1][1] < coords[1] < box[0][1]:
+                found = name
+        return found
+
+
+class StationKDTree:
+    """
+    A KD-tree over the transit stations. Coordinates are projected onto the
+    unit sphere, where the straight-line distance grows with the great-circle
+    distance, so the nearest point in 3D is also the nearest on the globe.
+    """
+    def __init__(self, stations):
+        """
+        Initializes an instance of this class.
+        :param stations: A dictionary of station names to (lat, lon), the same
+        format as settings.TRANSIT_STATIONS.
+        """
+        self.stations = list(stations.items())
+        points = [(self._to_xyz(coords[0], coords[1]), index)
+                  for index, (name, coords) in enumerate(self.stations)]
+        self.root = self._build(points, 0)
+
+    @staticmethod
+    def _to_xyz(lat, lon):
+        """
+        Projects a coordinate onto the unit sphere.
+        :param lat: The latitude.
+        :param lon: The longitude.
+        :return: A tuple of (x, y, z).
+        """
+        lat, lon = math.radians(lat), math.radians(lon)
+        return (math.cos(lat) * math.cos(lon),
+                math.cos(lat) * math.sin(lon),
+                math.sin(lat))
+
+    def _build(self, points, depth):
+        """
+        Builds a subtree by splitting the points on the median of one axis.
+        :param points: A list of (xyz, index) tuples.
+        :param depth: The depth of the subtree root.
+        :return: A node tuple of (xyz, index, axis, left, right), or None.
+        """
+        if not points:
+            return None
+
+        axis = depth % 3
+        points.sort(key=lambda point: point[0][axis])
+        median = len(points) // 2
+        xyz, index = points[median]
+        return (xyz, index, axis,
+                self._build(points[:median], depth + 1),
+                self._build(points[median + 1:], depth + 1))
+
+    def nearest(self, lat, lon):
+        """
+        Finds the station nearest to a coordinate. Ties go to the station
+        defined first, like a linear scan.
+        :param lat: The latitude.
+        :param lon: The longitude.
+        :return: A tuple of (station name, station coordinates), or None if
+        there are no stations.
+        """
+        if self.root is None:
+            return None
+
+        target = self._to_xyz(lat, lon)
+        best = [None, None]  # [squared distance, index]
+        self._search(self.root, target, best)
+        return self.stations[best[1]]
+
+    def _search(self, node, target, best):
+        """
+        Searches a subtree, updating the best match found so far.
+        :param node: The subtree root.
+        :param target: The (x, y, z) of the query.
+        :param best: A list of [squared distance, index] of the best match.
+        """
+        if node is None:
+            return
+
+        xyz, index, axis, left, right = node
+        dist = sum((a - b) ** 2 for a, b in zip(xyz, target))
+        if best[0] is None or dist < best[0] or (dist == best[0] and index < best[1]):
+            best[0] = dist
+            best[1] = index
+
+        # Search the side of the query first, then the other side if it can
+        # still hold a closer station
+        diff = target[axis] - xyz[axis]
+        near, far = (left, right) if diff < 0 else (right, left)
+        self._search(near, target, best)
+        if diff ** 2 <= best[0]:
+            self._search(far, target, best)
@@ -0,0 +1,232 @@
+import threading
+from sqlalchemy import create_engine, event, text, inspect
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Float, Boolean, Index
+from sqlalchemy import UniqueConstraint
+from sqlalchemy.orm import sessionmaker, scoped_session
+import settings
+
+Base = declarative_base()
+
+class Listing(Base):
+    """
+    A table to store data on craigslist listings.
+    """
+
+    __tablename__ = 'listings'
+    __table_args__ = (
+        # Indexes for the common reporting filters
+        Index('ix_listings_area_created', 'area', 'created'),
+        Index('ix_listings_area_price', 'area', 'price'),
+        Index('ix_listings_created', 'created'),
+        Index('ix_listings_commute_time_price', 'commute_time', 'price'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    link = Column(String, unique=True)
+    created = Column(DateTime)
+    geotag = Column(String)
+    lat = Column(Float)
+    lon = Column(Float)
+    name = Column(String)
+    price = Column(Float)
+    location = Column(String)
+    cl_id = Column(BigInteger, unique=True)
+    area = Column(String)
+    commute_time = Column(Float)
+    commute_estimated = Column(Boolean)
+    duplicate_of = Column(BigInteger)
+    minhash = Column(String)
+
+class ListingSignature(Base):
+    """
+    A table to store the locality-sensitive hashing buckets of each listing's
+    MinHash signature, to find near-duplicate listings without a full scan.
+    """
+
+    __tablename__ = 'listing_signatures'
+    __table_args__ = (
+        Index('ix_listing_signatures_bucket', 'bucket'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    cl_id = Column(BigInteger, index=True)
+    bucket = Column(BigInteger)
+
+class AreaState(Base):
+    """
+    A table to store the newest listing seen in each area, so the next scrape
+    only fetches the listings posted since.
+    """
+
+    __tablename__ = 'area_states'
+
+    key = Column(String, primary_key=True)
+    last_cl_id = Column(BigInteger)
+    last_created = Column(DateTime)
+
+class SeenListing(Base):
+    """
+    A table to store the ids of listings archived out of the listings table,
+    so they are still recognized as already seen.
+    """
+
+    __tablename__ = 'seen_listings'
+
+    cl_id = Column(BigInteger, primary_key=True, autoincrement=False)
+
+class EnrichmentBackfill(Base):
+    """
+    A table to queue the lookups of listings deferred while the Google Maps
+    budget was low, to be resolved once it recovers.
+    """
+
+    __tablename__ = 'enrichment_backfill'
+    __table_args__ = (
+        UniqueConstraint('cl_id', 'kind'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    cl_id = Column(BigInteger)
+    kind = Column(String)
+    enqueued_at = Column(DateTime)
+    attempts = Column(Integer, default=0)
+    claimed_by = Column(String)
+    claimed_until = Column(Float)
+
+def _create_listing_indexes(connection):
+    """
+    Creates the reporting indexes of the listings table.
+    :param connection: The connection to migrate.
+    """
+    for index in Listing.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+def _add_duplicate_columns(connection):
+    """
+    Adds the near-duplicate columns to the listings table.
+    :param connection: The connection to migrate.
+    """
+    columns = [info["name"] for info in inspect(connection).get_columns("listings")]
+    if "duplicate_of" not in columns:
+        connection.execute(text("ALTER TABLE listings ADD COLUMN duplicate_of INTEGER"))
+    if "minhash" not in columns:
+        connection.execute(text("ALTER TABLE listings ADD COLUMN minhash VARCHAR"))
+
+def _add_commute_estimated_column(connection):
+    """
+    Adds the column telling estimated commute times apart from looked up ones.
+    :param connection: The connection to migrate.
+    """
+    columns = [info["name"] for info in inspect(connection).get_columns("listings")]
+    if "commute_estimated" not in columns:
+        connection.execute(text("ALTER TABLE listings ADD COLUMN commute_estimated BOOLEAN"))
+
+def _widen_cl_id_columns(connection):
+    """
+    Widens the columns holding Craigslist ids to 64 bits, since the ids
+    no longer fit in 32. SQLite integers are always 64 bits, so only other
+    databases are altered.
+    :param connection: The connection to migrate.
+    """
+    if connection.dialect.name == "sqlite":
+        return
+
+    for table, column in [("listings", "cl_id"), ("listings", "duplicate_of"),
+                          ("listing_signatures", "cl_id"), ("area_states", "last_cl_id"),
+                          ("seen_listings", "cl_id"), ("enrichment_backfill", "cl_id")]:
+        connection.execute(text("ALTER TABLE {} ALTER COLUMN {} TYPE BIGINT".format(
+            table, column)))
+
+# Schema migrations as (version, description, function) tuples, applied in
+# order. Each function receives a connection inside a transaction, and must
+# work on a database created from the current models as well as an old one.
+MIGRATIONS = [
+    (1, "Add reporting indexes to listings", _create_listing_indexes),
+    (2, "Add near-duplicate columns to listings", _add_duplicate_columns),
+    (3, "Add commute estimate flag to listings", _add_commute_estimated_column),
+    (4, "Widen Craigslist id columns to 64 bits", _widen_cl_id_columns),
+]
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """
+    Gets the database engine, creating it and migrating the schema on first use.
+    :return: The SQLAlchemy engine.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_storage_engine(settings.DATABASE_URL)
+            migrate(_engine)
+        return _engine
+
+def create_storage_engine(url):
+    """
+    Creates a database engine. SQLite databases are tuned with the pragmas
+    from settings.SQLITE_PRAGMAS on every new connection.
+    :param url: The database URL, such as sqlite:///listings.db or a
+    postgresql:// URL.
+    :return: The SQLAlchemy engine.
+    """
+    if not url.startswith("sqlite"):
+        return create_engine(url, echo=False, pool_pre_ping=True)
+
+    engine = create_engine(url, echo=False,
+                           connect_args={'check_same_thread': False})
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        cursor.close()
+
+    return engine
+
+def migrate(engine):
+    """
+    Creates the missing tables and applies the pending migrations.
+    :param engine: The engine of the database to migrate.
+    """
+    Base.metadata.create_all(engine)
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+        version = connection.execute(text(
+            "SELECT MAX(version) FROM schema_version")).scalar() or 0
+
+    for migration_version, description, function in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        print("Migrating the database to version {}: {}".format(migration_version, description))
+        with engine.begin() as connection:
+            function(connection)
+            connection.execute(text("INSERT INTO schema_version (version) VALUES (:version)"),
+                               {"version": migration_version})
+
+def insert_ignoring_duplicates(table):
+    """
+    Builds an INSERT of many rows that skips the rows conflicting with a
+    unique constraint, such as a listing another worker saved first.
+    :param table: The table to insert into.
+    :return: The insert statement.
+    """
+    # The dialects are imported here, since importing them is slow
+    dialect = get_engine().dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects import sqlite
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        from sqlalchemy.dialects import postgresql
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return table.insert()
+
+# Each thread gets its own session; writes are serialized with the lock
+Session = sessionmaker()
+session = scoped_session(lambda: Session(bind=get_engine()))
+db_lock = threading.Lock()
@@ -0,0 +1,90 @@
+from collections import deque
+
+
+class PhraseMatcher:
+    """
+    An Aho-Corasick automaton over a list of phrases. A text is scanned once
+    to find every phrase in it, keeping only matches on word boundaries.
+    """
+    def __init__(self, phrases):
+        """
+        Initializes an instance of this class.
+        :param phrases: A list of phrases to look for. Matching is case
+        insensitive.
+        """
+        self.phrases = list(phrases)
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [[]]
+
+        # Build the trie of all phrases
+        for index, phrase in enumerate(self.phrases):
+            state = 0
+            for char in phrase.lower():
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._outputs.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            if phrase:
+                self._outputs[state].append(index)
+
+        # Link every state to its longest proper suffix in the trie
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._outputs[next_state] = (self._outputs[next_state] +
+                                             self._outputs[self._fail[next_state]])
+
+    def find_all(self, text):
+        """
+        Finds every phrase occurring in the text as whole words.
+        :param text: The text to scan.
+        :return: A list of (start, end, phrase index) tuples.
+        """
+        text = text.lower()
+        matches = []
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+
+            for index in self._outputs[state]:
+                end = position + 1
+                start = end - len(self.phrases[index])
+                if _is_boundary(text, start - 1) and _is_boundary(text, end):
+                    matches.append((start, end, index))
+        return matches
+
+    def find_longest(self, text):
+        """
+        Finds the longest phrase occurring in the text as whole words. Ties
+        go to the phrase that appears first in the text.
+        :param text: The text to scan.
+        :return: The matching phrase, or None if nothing matches.
+        """
+        best = None
+        for start, end, index in self.find_all(text):
+            if best is None or (end - start, -start) > (best[1] - best[0], -best[0]):
+                best = (start, end, index)
+        return None if best is None else self.phrases[best[2]]
+
+
+def _is_boundary(text, position):
+    """
+    Checks whether a position just outside a match is a word boundary.
+    :param text: The text being scanned.
+    :param position: The position next to the match.
+    :return: True if the position is outside the text or not a word character.
+    """
+    if position < 0 or position >= len(text):
+        return True
+    return not text[position].isalnum()